@@ -1,3 +1,7 @@
+import argparse
+import re
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
 import numpy as np
 import nltk
@@ -5,12 +9,22 @@ from nltk.corpus import wordnet
 from nltk.stem import WordNetLemmatizer
 from tqdm import tqdm
 
+# Automatic battle / journey annotation of the free responses, compared with the manual one.
+#
+# Every description is lemmatized (POS tagged, then lemmatized with WordNet) over a process pool, the key phrases of
+# both families are counted in all the lemmatized descriptions at once, and the predictions of both families are
+# scored against the manual counts in one step: confusion matrix, rates, precision, recall and F1.
+#
+# e.g. python analysis/annotate_free_response.py --workers 8 --out data/free_responses_annotated.csv
+
 EPS = 1e-7
 
 BATTLE_PHRASES =  ['fight', 'battle', 'war', 'beat', 'enemy', 'defeat', 'win',
                     'combat']
 JOURNEY_PHRASES = ['path', 'journey', 'road', 'rollercoaster', 'go through']
 
+PHRASES = {'battle': BATTLE_PHRASES, 'journey': JOURNEY_PHRASES}
+
 lemmatizer = WordNetLemmatizer()
 
 def nltktag_to_wntag(nltk_tag):
@@ -39,52 +53,89 @@ def lemmatize_sentence(sentence):
     return " ".join(res_words)
 
 
-def count_key_phrases(sentence):
-    battle_sum = sum(sentence.count(kw) for kw in BATTLE_PHRASES)
-    # print(f"Battle: {battle_sum}")
+def lemmatize(sentences, workers=1, chunk_size=64):
+    # the lemmatized sentences, in order
+    sentences = pd.Series(sentences).fillna('').astype(str)
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            lemmas = list(tqdm(pool.map(lemmatize_sentence, sentences, chunksize=chunk_size), total=len(sentences)))
+    else:
+        lemmas = [lemmatize_sentence(s) for s in tqdm(sentences)]
+
+    return pd.Series(lemmas, index=sentences.index)
+
 
-    journey_sum = sum(sentence.count(kw) for kw in JOURNEY_PHRASES)
-    # print(f"Journey: {journey_sum}")
+def count_key_phrases(sentences, phrases=PHRASES):
+    # (sentences x families) count of the key phrases of every family, like str.count summed over the phrases
+    sentences = pd.Series(sentences)
 
-    return {"battle": battle_sum, "journey": journey_sum}
+    return pd.DataFrame({family: sum(sentences.str.count(re.escape(kw)) for kw in keywords)
+                         for family, keywords in phrases.items()}, index=sentences.index)
 
-def true_positives(truth, prediction):
-    return (sum((truth > 0) & (prediction > 0)) + EPS) / (sum(truth > 0) + EPS)
 
-def true_negatives(truth, prediction):
-    return (sum((truth == 0) & (prediction == 0)) + EPS) / (sum(truth == 0) + EPS)
+def evaluate(truth, prediction):
+    # one row per family (the columns of truth / prediction) with its confusion matrix, rates, precision, recall and F1;
+    # a family is present in a response if its count is > 0
+    families = list(truth.columns)
+    truth = truth[families].to_numpy() > 0
+    prediction = prediction[families].to_numpy() > 0
 
-def false_positives(truth, prediction):
-    return (sum((truth == 0) & (prediction > 0)) + EPS) / (sum(truth == 0) + EPS)
+    tp = (truth & prediction).sum(axis=0)
+    tn = (~truth & ~prediction).sum(axis=0)
+    fp = (~truth & prediction).sum(axis=0)
+    fn = (truth & ~prediction).sum(axis=0)
+
+    precision = (tp + EPS) / (tp + fp + EPS)
+    recall = (tp + EPS) / (tp + fn + EPS)
+
+    return pd.DataFrame({
+        'tp': tp, 'fn': fn, 'fp': fp, 'tn': tn,
+        'true_positive_rate': recall,
+        'true_negative_rate': (tn + EPS) / (tn + fp + EPS),
+        'false_positive_rate': (fp + EPS) / (tn + fp + EPS),
+        'false_negative_rate': (fn + EPS) / (tp + fn + EPS),
+        'precision': precision,
+        'recall': recall,
+        'f1': 2 * precision * recall / (precision + recall),
+    }, index=pd.Index(families, name='family'))
+
+
+def annotate(data, workers=1):
+    # data with the predicted counts of every family (battle_pred, journey_pred)
+    counts = count_key_phrases(lemmatize(data['description'], workers))
+
+    return data.assign(**{f'{family}_pred': counts[family] for family in PHRASES})
 
-def false_negatives(truth, prediction):
-    return (sum((truth > 0) & (prediction == 0)) + EPS) / (sum(truth > 0) + EPS)
 
 def main():
-    data = pd.read_csv("data/free_responses_pre15.csv")
-    data["battle_pred"] = 0
-    data["journey_pred"] = 0
+    parser = argparse.ArgumentParser(description='Annotate the free responses and compare with the manual labels')
+    parser.add_argument('--path', default='data/free_responses_pre15.csv')
+    parser.add_argument('--out', help='where to save the responses with the predicted counts')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--limit', type=int, help='only the first responses')
+    args = parser.parse_args()
+
+    data = pd.read_csv(args.path, nrows=args.limit)
     print(f"Data shape: {data.shape}")
 
-    MAX = 50
+    data = annotate(data, args.workers)
+
+    if args.out is not None:
+        data.to_csv(args.out, index=False)
 
-    for i in tqdm(range(MAX)):
-        transformed_sentence = lemmatize_sentence(data.iloc[i, 6])
+    metrics = evaluate(data[list(PHRASES)], data[[f'{family}_pred' for family in PHRASES]].set_axis(list(PHRASES), axis=1))
 
-        counts = count_key_phrases(transformed_sentence)
-        # print((counts, data.iloc[i, 3], data.iloc[i, 2]))
-        data.iloc[i, 7] = counts["battle"]
-        data.iloc[i, 8] = counts["journey"]
+    for family, row in metrics.iterrows():
+        print()
+        print(f"{family.capitalize()}: {row['tp']:.0f} TP, {row['fn']:.0f} FN, {row['fp']:.0f} FP, {row['tn']:.0f} TN")
+        print(f"{family.capitalize()} true positive rate: {row['true_positive_rate']:.2f}")
+        print(f"{family.capitalize()} true negative rate: {row['true_negative_rate']:.2f}")
+        print(f"{family.capitalize()} false positive rate: {row['false_positive_rate']:.2f}")
+        print(f"{family.capitalize()} false negative rate: {row['false_negative_rate']:.2f}")
+        print(f"{family.capitalize()} precision: {row['precision']:.2f}, recall: {row['recall']:.2f}, "
+              f"F1: {row['f1']:.2f}")
 
-    print()
-    print(f"Battle true positive rate: {true_positives(data.iloc[:MAX, 3], data.iloc[:MAX, 7]):.2f}")
-    print(f"Battle true negative rate: {true_negatives(data.iloc[:MAX, 3], data.iloc[:MAX, 7]):.2f}")
-    print(f"Battle false positive rate: {false_positives(data.iloc[:MAX, 3], data.iloc[:MAX, 7]):.2f}")
-    print(f"Battle false negative rate: {false_negatives(data.iloc[:MAX, 3], data.iloc[:MAX, 7]):.2f}")
-    print()
-    print(f"Journey true positive rate: {true_positives(data.iloc[:MAX, 2], data.iloc[:MAX, 8]):.2f}")
-    print(f"Journey true negative rate: {true_negatives(data.iloc[:MAX, 2], data.iloc[:MAX, 8]):.2f}")
-    print(f"Journey false positive rate: {false_positives(data.iloc[:MAX, 2], data.iloc[:MAX, 8]):.2f}")
-    print(f"Journey false negative rate: {false_negatives(data.iloc[:MAX, 2], data.iloc[:MAX, 8]):.2f}")
 
-main()
+if __name__ == '__main__':
+    main()
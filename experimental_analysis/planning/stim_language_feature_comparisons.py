@@ -1,97 +1,38 @@
-import pandas as pd
-import numpy as np
-import re
-from tqdm import tqdm
-import nltk
-from nltk.tokenize import RegexpTokenizer
-tokenizer = RegexpTokenizer(r'\w+')
+import os.path as op
+import sys
+
+# the feature builders are shared with the GoFundMe pipeline
+sys.path.append(op.join(op.dirname(op.abspath(__file__)), '..', '..', 'gofundme_analysis', 'preprocessing'))
+from features import Plan
+from instrument import Run
+from labeled_store import read_labeled
+from metaphors import LABELED_FEATURE_COLUMNS
+from rarity import KeywordWeights
+from storage import read_table, write_table
 
 
 STATE_ABRV = ['AL', 'AK', 'AZ', 'AR', 'CA', 'CO', 'CT', 'DC', 'DE', 'FL', 'GA', 'HI', 'ID', 'IL', 'IN', 'IA', 'KS',
               'KY', 'LA', 'ME', 'MD', 'MA', 'MI', 'MN', 'MS', 'MO', 'MT', 'NE', 'NV', 'NH', 'NJ', 'NM', 'NY', 'NC',
               'ND', 'OH', 'OK', 'OR', 'PA', 'RI', 'SC', 'SD', 'TN', 'TX', 'UT', 'VT', 'VA', 'WA', 'WV', 'WI', 'WY']
 
-CANCER_TYPES = ["breast cancer", "lung cancer", "leukemia", "prostate cancer", "melanoma",
-                 "lymphoma", "bone cancer", "skin cancer", "bladder cancer", "kidney cancer",
-                 "brain cancer", "liver cancer", "pancreatic cancer", "testicular cancer",
-                 "colon cancer", "cervical cancer", "esophageal cancer", "neuroblastoma"]
-
-
-def get_cancer_type(text):
-    ts = []
 
-    if isinstance(text, float):
-        return "unknown"
+# the custom campaigns with a text, with the same features as the GoFundMe projects
+STIM = Plan(['text_length_words', 'text_length_sentences', 'cancer_type', 'battle_metaphor', 'journey_metaphor',
+             'battle_uniques', 'journey_uniques', 'battle_salience', 'journey_salience', 'first_instantiation',
+             'battle_prod', 'journey_prod'], where=['has_text'])
 
-    for t in CANCER_TYPES:
-        if t in text.lower():
-            ts.append(t)
 
-    if len(ts) == 0:
-        return "general"
-    elif len(ts) == 1:
-        return ts[0]
-    else:
-        return "mixed"
-
-
-def process():
+def process(workers=1, run=None, features=None, fast_words=False, labeled_path='src/reports/labeled.csv',
+            projects_path='src/reports/projects.csv', out_path='src/reports/projects_full.csv'):
 
     print('Processing Custom Campaigns')
 
-    pbar = tqdm(total=7)
-
-
-    labeled = pd.read_csv('src/reports/labeled.csv')
-    data = pd.read_csv('src/reports/projects.csv').dropna()
-    pbar.update()
-
-
-    data = data[data['text'].apply(lambda t: isinstance(t, str))]
-    data['text_length_words'] = data['text'].apply(lambda t: len(tokenizer.tokenize(t)))
-    data = data[data['text_length_words'] > 0]
-    data['text_length_sentences'] = data['text'].apply(
-        lambda t: len(nltk.sent_tokenize(t)) if isinstance(t, str) else 0
-    )
-    pbar.update()
-
-    data['cancer_type'] = data['text'].apply(get_cancer_type)
-    pbar.update()
-
-    # for every project ID, how many general keywords of type x were labeled for them?
-    data['battle_metaphor'] = data['id'].apply(
-        lambda ix: len(labeled.loc[(labeled['project_id'] == ix) & (labeled['type'] == 'battle') & (labeled['metaphorical'] == True)])
-    )
-    pbar.update()
-    data['journey_metaphor'] = data['id'].apply(
-        lambda ix: len(labeled.loc[(labeled['project_id'] == ix) & (labeled['type'] == 'journey') & (labeled['metaphorical'] == True)])
-    )
-    pbar.update()
+    # per-stage timings and memory, see gofundme_analysis/preprocessing/instrument.py
+    run = Run.from_env('stim') if run is None else run
 
-    # for every project ID, how many specific keywords of type x were labeled for them?
-    data['battle_uniques'] = data['id'].apply(
-        lambda ix: len(set(labeled.loc[(labeled['project_id'] == ix) & (labeled['type'] == 'battle') & (labeled['metaphorical'] == True), 'keyword']))
-    )
-    pbar.update()
-    data['journey_uniques'] = data['id'].apply(
-        lambda ix: len(set(labeled.loc[(labeled['project_id'] == ix) & (labeled['type'] == 'journey') & (labeled['metaphorical'] == True), 'keyword']))
-    )
-    pbar.update()
-
-    # see the comments at the top for a description on these variables
-    data['battle_salience'] = data['battle_metaphor'] / data['text_length_words']
-    data['journey_salience'] = data['journey_metaphor'] / data['text_length_words']
-    pbar.update()
-
-    def first_instantiation(id):
-        locs = labeled.loc[(labeled['project_id'] == id) & (labeled['metaphorical'] == True), 'char_location'].values
-        if locs.any() and data.loc[data['id'] == id, 'text'].any():
-            return locs.min() / (len(data.loc[data['id'] == id, 'text'].values[0]) + 1)
-
-        return -1
-
-    data['first_instantiation'] = data['id'].apply(first_instantiation)
-    pbar.update()
+    with run.stage('read'):
+        labeled = read_labeled(labeled_path, LABELED_FEATURE_COLUMNS)
+        data = read_table(projects_path).dropna()
 
     # compute frequency maps
     battle_freq_map = {'fight': 1.0, 'battle': 1.229309058385031, 'fighting': 1.4433547113246208, 'beat': 1.6808340642450945,
@@ -103,33 +44,19 @@ def process():
 
     journey_freq_map = {'journey': 1.0, 'path': 2.67308106226671, 'road': 3, 'travel': 3.5}
 
-    productivities = []
-
-    # group by id
-    for i, g in labeled.loc[labeled['metaphorical'] == True].groupby('project_id'):
-
-        kw = g.loc[g['type'] == 'battle', 'keyword'].value_counts()
-        s = [battle_freq_map[k] * kw[k] for k in dict(kw) if k in battle_freq_map]
-        battle_div = sum(s) / kw.sum() if len(kw) > 0 else 0
+    # weighted keyword productivity of every family, see gofundme_analysis/preprocessing/rarity.py
+    weights = KeywordWeights({'battle': battle_freq_map, 'journey': journey_freq_map})
 
-        kw = g.loc[g['type'] == 'journey', 'keyword'].value_counts()
-        s = [journey_freq_map[k] * kw[k] for k in dict(kw) if k in journey_freq_map]
-        journey_div = sum(s) / kw.sum() if len(kw) > 0 else 0
-
-        productivities.append([i, battle_div, journey_div])
-
-    productivities = pd.DataFrame(productivities, columns=['id', 'battle_prod', 'journey_prod'])
-    data = data.merge(productivities, how='left', on='id', validate='one_to_one')
-
-    data['battle_prod'] = data['battle_prod'].fillna(0)
-    data['journey_prod'] = data['journey_prod'].fillna(0)
-
-    pbar.update()
+    # see gofundme_analysis/preprocessing/features.py; only the STIM columns in features, if given
+    resources = {'labeled': labeled, 'keyword_weights': weights, 'fast_words': fast_words}
+    data = STIM.select(features).run(data, resources, workers=workers, run=run)
 
     data['text'] = ""
 
-    data.to_csv('src/reports/projects_full.csv', index=False)
-    pbar.close()
+    with run.stage('write', len(data)):
+        write_table(data, out_path)
+
+    run.finish()
 
 if __name__ == '__main__':
     process()
\ No newline at end of file
@@ -1,57 +1,240 @@
+import argparse
+import csv
 import os.path as op
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 import numpy as np
 
+import shared
+from labeled_store import LabeledStore, read_labeled, up_to_date
+from storage import parquet_path, read_table, write_table
+
+# Review the metaphoricity labels of the GoFundMe fragments.
+#
+# The fragments are queued once, in one of three orders:
+#
+# random: like sampling the labeled fragments one at a time.
+#
+# keyword: stratified by keyword, one fragment of every keyword in turn (in a random order within each keyword).
+#
+# uncertainty: the fragments the classifier is least sure about first, from the probabilities of infer.py.
+#
+# Fragments that already have a decision in the corrections log are skipped. While a fragment is reviewed the next one
+# (with its project name and +-300 characters of context) is prepared in a thread. Every decision is appended to the
+# corrections log (project_id, char_location, keyword, previous and new label), and merge applies the latest decision
+# of every fragment to labeled.csv (and its Parquet version and store, if it has them, see storage.py and
+# labeled_store.py) in one write:
+#
+#   python exploration/v2/corrections.py review --order uncertainty --predictions ../../data/processed/predicted.csv
+#   python exploration/v2/corrections.py merge
+
 DATA_PROCESSED = '../../data/processed'
 
+CONTEXT = 300
+
+ORDERS = ['random', 'keyword', 'uncertainty']
+
+KEY = ['project_id', 'char_location', 'keyword']
+
+LOG_COLUMNS = KEY + ['previous', 'metaphorical', 'reviewed_at']
+
+
+def load_projects(path):
+    # (project id index, names, texts) of the GoFundMe projects
+    projects = read_table(path, columns=['id', 'name', 'text', 'source'])
+    projects = projects.loc[projects["source"] == "gofundme"].drop_duplicates('id')
+
+    return pd.Index(projects["id"]), projects["name"].values, projects["text"].values
+
+
+def read_log(path):
+    if not op.exists(path):
+        return pd.DataFrame(columns=LOG_COLUMNS)
+
+    return pd.read_csv(path)
+
+
+def queue(labeled, order, predictions=None, seed=None):
+    # the rows of labeled in review order
+    rng = np.random.default_rng(seed)
+    rows = rng.permutation(len(labeled))
+
+    if order == 'keyword':
+        # rank of every fragment within its keyword, so taking the ranks in turn takes every keyword in turn
+        shuffled = labeled.iloc[rows]
+        rank = shuffled.groupby("keyword", observed=True).cumcount().values
+        rows = rows[np.argsort(rank, kind='stable')]
+    elif order == 'uncertainty':
+        if predictions is None:
+            raise ValueError('the uncertainty order needs the predictions of infer.py')
+        probability = labeled[KEY].merge(predictions[KEY + ["probability"]].drop_duplicates(KEY), on=KEY,
+                                         how='left')["probability"].values
+        margin = np.abs(probability - 0.5)
+        # fragments without a prediction go last
+        margin = np.where(np.isnan(margin), np.inf, margin)
+        rows = rows[np.argsort(margin[rows], kind='stable')]
+
+    return labeled.iloc[rows]
 
-def main():
-    # projects without any metaphor features
-    all_projects = pd.read_csv(op.join(DATA_PROCESSED, 'combined_projects.csv'))
 
-    # fragments that have been labeled for metaphoricity
-    labeled = pd.read_csv(op.join(DATA_PROCESSED, 'labeled.csv'))
+class Reviewer:
 
-    projects = all_projects.loc[all_projects["source"] == "gofundme"]
-    labeled = labeled.loc[labeled["project_id"].isin(projects["id"])].dropna()
+    def __init__(self, labeled, ids, names, texts, log_path):
+        self.labeled = labeled
+        self.ids = ids
+        self.names = names
+        self.texts = texts
+        self.log_path = log_path
 
-    print(f'GFM Projects DF: {len(projects):,}')
-    print(f'Labeled Keywords DF: {len(labeled):,}')
+    def prepare(self, position):
+        # everything shown for the fragment at position of the queue
+        row = self.labeled.iloc[position]
+        project = self.ids.get_loc(row["project_id"])
+        location = int(row["char_location"])
+        text = self.texts[project]
 
-    fetch = int(input("How many to fetch? "))
+        return {
+            "row": row,
+            "name": self.names[project],
+            "context": text[max(location - CONTEXT, 0):min(location + CONTEXT, len(text))],
+        }
+
+    def log(self, row, metaphorical):
+        new = not op.exists(self.log_path)
+        with open(self.log_path, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if new:
+                writer.writerow(LOG_COLUMNS)
+            previous = row["metaphorical"]
+            writer.writerow([row["project_id"], row["char_location"], row["keyword"],
+                             '' if pd.isna(previous) else bool(previous), metaphorical,
+                             time.strftime('%Y-%m-%d %H:%M:%S')])
+
+    def review(self, count):
+        # ask about the first count fragments of the queue, the next one is prepared while waiting for the answer
+        reviewed, corrections = 0, 0
+
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            pending = pool.submit(self.prepare, 0) if len(self.labeled) > 0 else None
+
+            for position in range(min(count, len(self.labeled))):
+                item = pending.result()
+                if position + 1 < len(self.labeled):
+                    pending = pool.submit(self.prepare, position + 1)
+
+                row = item["row"]
+                print(f'{row["project_id"]} {item["name"]}')
+                print(row["fragment"])
+                met = input("Metaphorical? [y/n, c: context, s: skip, q: quit] ")
+
+                if met == "c":
+                    print(item["context"])
+                    met = input("Metaphorical? ")
+
+                if met == "q":
+                    break
+                if met == "s":
+                    print()
+                    continue
+
+                met = True if met == "y" else False
+                self.log(row, met)
+                reviewed += 1
+
+                if not pd.isna(row["metaphorical"]) and met != row["metaphorical"]:
+                    print(f"Correction to be made {row['project_id'][:10]} - {int(row['char_location'])}")
+                    corrections += 1
+
+                print()
+
+        print(f"Reviewed: {reviewed}, total corrections: {corrections}")
+
+
+def review(order='random', count=None, predictions_path=None, unlabeled=False, seed=None,
+           projects_path=op.join(DATA_PROCESSED, 'combined_projects.csv'),
+           labeled_path=op.join(DATA_PROCESSED, 'labeled.csv'),
+           log_path=op.join(DATA_PROCESSED, 'corrections.csv')):
+    ids, names, texts = load_projects(projects_path)
+
+    # fragments that have been labeled for metaphoricity (or all of them, with unlabeled)
+    labeled = read_labeled(labeled_path, columns=KEY + ['fragment', 'metaphorical'])
+    labeled = labeled.loc[labeled["project_id"].isin(ids) & labeled["fragment"].notna()]
+    if not unlabeled:
+        labeled = labeled.loc[labeled["metaphorical"].notna()]
+
+    # the fragments already reviewed
+    done = read_log(log_path)[KEY].drop_duplicates()
+    labeled = labeled.merge(done, on=KEY, how='left', indicator=True)
+    labeled = labeled.loc[labeled["_merge"] == 'left_only'].drop(columns="_merge")
+
+    print(f'GFM Projects DF: {len(ids):,}')
+    print(f'Fragments to review: {len(labeled):,}')
+
+    predictions = read_table(predictions_path, columns=KEY + ['probability']) if predictions_path else None
+    labeled = queue(labeled, order, predictions, seed)
+
+    if count is None:
+        count = int(input("How many to fetch? "))
     print()
 
-    corrections = 0
+    Reviewer(labeled, ids, names, texts, log_path).review(count)
 
-    for i in range(fetch):
-        sample = labeled.sample()
 
-        id = sample["project_id"].values[0]
-        fragment = sample["fragment"].values[0]
-        char_location = int(sample["char_location"].values[0])
-        metaphorical = sample["metaphorical"].values[0]
+def merge(labeled_path=op.join(DATA_PROCESSED, 'labeled.csv'), log_path=op.join(DATA_PROCESSED, 'corrections.csv')):
+    # apply the latest decision of every reviewed fragment to labeled.csv
+    log = read_log(log_path)
+    if len(log) == 0:
+        print('No corrections to merge')
+        return
 
-        project = projects.loc[projects["id"] == id, ]
+    stored = up_to_date(labeled_path)
+    labeled = read_table(labeled_path)
 
-        print(f'{id} {project["name"].values[0]}')
-        print(fragment)
-        met = input("Metaphorical? ")
+    latest = log.drop_duplicates(KEY, keep='last')[KEY + ['metaphorical']].rename(columns={'metaphorical': 'decision'})
+    decisions = labeled[KEY].merge(latest, on=KEY, how='left')['decision']
+    found = decisions.notna().values
+
+    labeled['metaphorical'] = labeled['metaphorical'].astype(object)
+    changed = found & (decisions.values != labeled['metaphorical'].values)
+    labeled.loc[found, 'metaphorical'] = decisions.values[found].astype(bool)
+
+    # labeled.csv stays a CSV, its Parquet version is only rewritten if there is one
+    write_table(labeled, labeled_path, parquet=op.exists(parquet_path(labeled_path)))
+
+    # keep the store up to date with the new labels
+    if stored:
+        store = LabeledStore.load(labeled_path)
+        store.metaphorical[found] = decisions.values[found].astype(bool)
+        store.save(labeled_path)
+
+    print(f'Merged {found.sum():,} decisions ({changed.sum():,} changed labels) into {labeled_path}, '
+          f'{len(latest) - found.sum():,} reviewed fragments are no longer in it')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Review the metaphoricity labels of the GoFundMe fragments')
+    commands = parser.add_subparsers(dest='command')
 
-        if met == "c":
-            text = project["text"].values[0]
-            print(text[max(char_location - 300, 0):min(char_location + 300, len(text))])
-            met = input("Metaphorical? ")
+    reviewing = commands.add_parser('review', help='review fragments, appending the decisions to the corrections log')
+    reviewing.add_argument('--order', choices=ORDERS, default='random')
+    reviewing.add_argument('--count', type=int, help='fragments to review (asked if not given)')
+    reviewing.add_argument('--predictions', help='infer.py output, for --order uncertainty')
+    reviewing.add_argument('--unlabeled', action='store_true', help='also review the fragments without a label')
+    reviewing.add_argument('--seed', type=int)
 
-        met = True if met == "y" else False
+    commands.add_parser('merge', help='apply the corrections log to labeled.csv')
 
-        if met != metaphorical:
-            print(f"Correction to be made {id[:10]} - {char_location}")
-            corrections += 1
+    args = parser.parse_args()
 
-        print()
+    if args.command == 'merge':
+        merge()
+    elif args.command == 'review':
+        review(args.order, args.count, args.predictions, args.unlabeled, args.seed)
+    else:
+        review()
 
-    print(f"Total corrections: {corrections}")
 
 if __name__ == '__main__':
     main()
@@ -1,31 +1,56 @@
+import argparse
 import pandas as pd
 import numpy as np
 
 import os.path as op
-
-import transformers as tn
+import time
 
 import torch as tt
 
 import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as func
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import Dataset
+
+import shared
+from storage import read_table
+
+from embedder import Embedder
+from embedding_cache import EmbeddingCache, text_hash
+
+MODEL = 'gpt2'
+
+# GPT-2 embeddings of the projects, see embedding_cache.py
+EMBEDDINGS = '../../data/processed/embeddings'
 
 
 class Data(Dataset):
-    def __init__(self, data):
-        self.data = data
+    # the embeddings and labels of all the projects as two contiguous tensors, batched by index instead of collating
+    # one project at a time
+    def __init__(self, embeddings, labels):
+        self.embeddings = tt.as_tensor(np.ascontiguousarray(embeddings, dtype=np.float32))
+        self.labels = tt.as_tensor(np.asarray(labels, dtype=np.int64))
 
     def __len__(self):
-        return len(self.data)
+        return len(self.labels)
 
     def __getitem__(self, ix):
         return {
-            "target": self.data.loc[ix, "label"],
-            "embedding": self.data.loc[ix, "embedding"]
+            "target": self.labels[ix],
+            "embedding": self.embeddings[ix]
         }
 
+    def batches(self, batch_size=32, shuffle=True):
+        # (embeddings, targets) of every batch, gathered into the same preallocated batch tensors
+        order = tt.randperm(len(self)) if shuffle else tt.arange(len(self))
+        embeddings = tt.empty((batch_size, self.embeddings.size(1)))
+        targets = tt.empty(batch_size, dtype=tt.int64)
+
+        for start in range(0, len(self), batch_size):
+            ix = order[start:start + batch_size]
+            yield (tt.index_select(self.embeddings, 0, ix, out=embeddings[:len(ix)]),
+                   tt.index_select(self.labels, 0, ix, out=targets[:len(ix)]))
+
 
 class Net(nn.Module):
     def __init__(self):
@@ -43,30 +68,38 @@ class Net(nn.Module):
         return x
 
 
-def train(loader, net, opt, crit):
-    print("Begin Training")
+def train(data, net, opt, crit, epochs=3, batch_size=32, threads=None):
+    # every step frees its graph; returns the samples / second of every epoch
+    if threads is not None:
+        tt.set_num_threads(threads)
+
+    print(f"Begin Training ({tt.get_num_threads()} threads)")
+
+    throughput = []
 
-    for epoch in range(1, 3 + 1):
-        loss_running = 0.0
+    for epoch in range(1, epochs + 1):
+        loss_running = tt.zeros(())
+        batches = 0
 
         net.train()
-        print(f"Epoch {epoch}")
-        for i, batch in enumerate(loader):
-            targets, embeddings = batch
+        start = time.perf_counter()
 
-            opt.zero_grad()
+        for embeddings, targets in data.batches(batch_size):
+            opt.zero_grad(set_to_none=True)
 
-            outs = net(batch[embeddings])
+            outs = net(embeddings)
 
-            loss = crit(tt.softmax(outs, dim=0), batch[targets])
-            loss.backward(retain_graph=True)
+            loss = crit(tt.softmax(outs, dim=0), targets)
+            loss.backward()
             opt.step()
 
-            loss_running += loss.item()
+            loss_running += loss.detach()
+            batches += 1
 
-            if i % 2 == 1:
-                print(f"B:{i} L:{loss_running / 2}")
-                loss_running = 0.0
+        seconds = time.perf_counter() - start
+        throughput.append(len(data) / seconds)
+        print(f"Epoch {epoch} L:{loss_running.item() / max(batches, 1):.4f} "
+              f"({seconds:.2f} s, {throughput[-1]:,.0f} samples/s)")
 
     print("Finished Training")
 
@@ -74,39 +107,51 @@ def train(loader, net, opt, crit):
 
     print("Model Saved")
 
+    return throughput
 
-def main():
 
-    ids = pd.read_csv("ids.csv")
+def embed_projects(ids, data, quantized=False):
+    # (ids x 2 * 768) GPT-2 embeddings of the name and first 250 characters of the text of the projects of data
+    projects = data.drop_duplicates('id').set_index('id').reindex(ids)
+    names, texts = projects['name'].tolist(), projects['text'].str[:250].tolist()
+    hashes = [text_hash(name, text) for name, text in zip(names, texts)]
 
-    tokenizer = tn.GPT2Tokenizer.from_pretrained("gpt2")
-    model = tn.GPT2Model.from_pretrained("gpt2")
+    # the int8 embeddings (see embedder.py) are cached apart from the float32 ones
+    cache = EmbeddingCache(EMBEDDINGS, (MODEL + '-int8') if quantized else MODEL, 2 * 768)
+    missing = np.flatnonzero(cache.missing(ids, hashes))
 
-    DATA_PROCESSED = '../../data/processed'
-    data = pd.read_csv(op.join(DATA_PROCESSED, 'gofundme_projects.csv')).dropna()
+    # the transformer is only loaded to embed the new or changed campaigns, see embedder.py
+    if len(missing) > 0:
+        embedder = Embedder(MODEL, quantized=quantized)
 
-    print("Data loaded")
+        vectors = np.concatenate([embedder.last_token([names[i] for i in missing]),
+                                  embedder.last_token([texts[i] for i in missing])], axis=1)
 
-    def embed(_id):
-        name = data.loc[data["id"] == _id, "name"].values[0]
-        text = data.loc[data["id"] == _id, "text"].values[0][:250]
+        cache.add(np.asarray(ids)[missing], [hashes[i] for i in missing], vectors)
 
-        encoding = tt.tensor(tokenizer.encode(name, add_special_tokens=True)).unsqueeze(0)
+    print(f"Embeddings created ({len(missing):,} new, {len(ids) - len(missing):,} cached)")
 
-        out_name = model(encoding)
+    return cache.get(ids, hashes)
 
-        encoding = tt.tensor(tokenizer.encode(text, add_special_tokens=True)).unsqueeze(0)
 
-        out_text = model(encoding)
+def main():
+    parser = argparse.ArgumentParser(description='Train the cancer campaign detector on the GPT-2 project embeddings')
+    parser.add_argument('--epochs', type=int, default=3)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--threads', type=int, help='intra-op threads of torch')
+    parser.add_argument('--quantized', action='store_true', help='embed the projects with the int8 quantized GPT-2')
+    args = parser.parse_args()
 
-        return tt.cat([out_name[0][0, -1], out_text[0][0, -1]], dim=0)
+    ids = pd.read_csv("ids.csv")
+
+    DATA_PROCESSED = '../../data/processed'
+    data = read_table(op.join(DATA_PROCESSED, 'gofundme_projects.csv'), columns=['id', 'name', 'text']).dropna()
 
-    ids["embedding"] = ids["id"].apply(embed)
+    print("Data loaded")
 
-    print("Embeddings created")
+    embeddings = embed_projects(ids['id'], data, args.quantized)
 
-    d = Data(ids)
-    loader = DataLoader(d, shuffle=True, batch_size=32)
+    d = Data(embeddings, ids["label"].values)
 
     net = Net()
     print("Network built")
@@ -114,7 +159,7 @@ def main():
     crit = nn.CrossEntropyLoss()
     opt = optim.Adam(net.parameters(), lr=0.01)
 
-    train(loader, net, opt, crit)
+    train(d, net, opt, crit, args.epochs, args.batch_size, args.threads)
 
     exit(0)
 
@@ -0,0 +1,251 @@
+import argparse
+import os
+import os.path as op
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import transformers
+
+import torch as tt
+import torch.nn as nn
+
+try:
+    from transformers.pytorch_utils import Conv1D
+except ImportError:
+    from transformers.modeling_utils import Conv1D
+
+# Batched transformer embeddings of campaign texts and labeled fragments.
+#
+# Texts are sorted by length and tokenized in batches of batch_size, padded only to the longest text of their batch,
+# with an attention mask so the padding never changes the states of the real tokens. The model runs under
+# tt.inference_mode (no autograd graph) and the outputs of every batch are copied into a single preallocated float32
+# array, in the order of the texts. Tokenization runs in a thread, a few batches ahead of the model:
+#
+# last_token: (texts x hidden) state of the last token of every text, what GPT-2 gives as a summary of the sequence.
+#
+# token_states: (texts x length x hidden) states of the first length tokens of every text, zero padded.
+#
+# ragged_token_states: the same states without the padding, as one flat (tokens x hidden) array with the offsets of
+# every text into it (the states of text i are flat[offsets[i]:offsets[i + 1]]).
+#
+# pooled: one vector per text, the state of the keyword token and / or the mean of the token states.
+#
+# quantized=True runs the model with dynamic int8 quantization of its linear layers (GPT-2's Conv1D layers are turned
+# into linear layers first), for CPU inference. The quantized model is saved in data/processed/quantized the first time,
+# and loaded from there afterwards; quantization.py compares it with the float32 model.
+#
+# python exploration/v2/embedder.py --limit 2000 compares the throughput with embedding one fragment at a time.
+
+DATA_PROCESSED = '../../data/processed'
+
+QUANTIZED = op.join(DATA_PROCESSED, 'quantized')
+
+
+def conv1d_to_linear(model):
+    # replace the transformers Conv1D layers (GPT-2) by the equivalent nn.Linear, which dynamic quantization handles
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, Conv1D):
+                linear = nn.Linear(child.weight.size(0), child.weight.size(1))
+                linear.weight.data = child.weight.data.t().contiguous()
+                linear.bias.data = child.bias.data
+                setattr(module, name, linear)
+
+    return model
+
+
+def quantize(model):
+    return tt.quantization.quantize_dynamic(conv1d_to_linear(model), {nn.Linear}, dtype=tt.qint8)
+
+
+def quantized_path(model_name, cache_dir=QUANTIZED):
+    # the whole module is pickled, so it's only reused with the same torch and transformers
+    return op.join(cache_dir, f"{model_name.replace('/', '--')}-int8-torch{tt.__version__}"
+                              f"-transformers{transformers.__version__}.pt")
+
+
+def load_quantized(model_name, cache_dir=QUANTIZED):
+    path = quantized_path(model_name, cache_dir)
+    if op.exists(path):
+        return tt.load(path, weights_only=False)
+
+    model = transformers.AutoModel.from_pretrained(model_name)
+    model.eval()
+    model = quantize(model)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tt.save(model, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+    return model
+
+
+class Embedder:
+
+    def __init__(self, model_name, batch_size=32, threads=None, prefetch=2, quantized=False, cache_dir=QUANTIZED):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.prefetch = prefetch
+        self.quantized = quantized
+
+        if threads is not None:
+            tt.set_num_threads(threads)
+
+        self.tokenizer = transformers.AutoTokenizer.from_pretrained(model_name)
+        if quantized:
+            self.model = load_quantized(model_name, cache_dir)
+        else:
+            self.model = transformers.AutoModel.from_pretrained(model_name)
+        self.model.eval()
+
+        # GPT-2 has no padding token, the padding is masked out anyway
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.tokenizer.padding_side = 'right'
+
+        self.hidden = self.model.config.hidden_size
+        self.max_length = self.tokenizer.model_max_length if self.tokenizer.model_max_length < 10 ** 6 else None
+
+    def token_lengths(self, texts):
+        encoding = self.tokenizer(list(texts), truncation=self.max_length is not None, max_length=self.max_length)
+
+        return np.array([len(ids) for ids in encoding['input_ids']], dtype=np.int64)
+
+    def tokenize(self, texts, positions):
+        return positions, self.tokenizer([texts[i] for i in positions], padding=True, return_tensors='pt',
+                                         truncation=self.max_length is not None, max_length=self.max_length)
+
+    def batches(self, texts, lengths=None):
+        # (positions in texts, model outputs, tokenizer encoding) of every batch, shortest texts first; the next
+        # prefetch batches are tokenized in a thread while the model runs
+        lengths = [len(t) for t in texts] if lengths is None else lengths
+        order = np.argsort(lengths, kind='stable')
+        batches = [order[start:start + self.batch_size] for start in range(0, len(order), self.batch_size)]
+
+        with ThreadPoolExecutor(max_workers=1) as pool, tt.inference_mode():
+            pending = [pool.submit(self.tokenize, texts, b) for b in batches[:self.prefetch + 1]]
+
+            for k in range(len(batches)):
+                positions, encoding = pending.pop(0).result()
+                if k + self.prefetch + 1 < len(batches):
+                    pending.append(pool.submit(self.tokenize, texts, batches[k + self.prefetch + 1]))
+
+                out = self.model(**encoding)
+
+                yield positions, out[0], encoding
+
+    def last_token(self, texts):
+        texts = list(texts)
+        embeddings = np.empty((len(texts), self.hidden), dtype=np.float32)
+
+        for positions, states, encoding in self.batches(texts):
+            last = encoding['attention_mask'].sum(dim=1) - 1
+            embeddings[positions] = states[tt.arange(len(positions)), last].numpy()
+
+        return embeddings
+
+    def token_states(self, texts, length=64):
+        texts = list(texts)
+        embeddings = np.zeros((len(texts), length, self.hidden), dtype=np.float32)
+
+        for positions, states, encoding in self.batches(texts):
+            states = (states[:, :length] * encoding['attention_mask'][:, :length, None]).numpy()
+            embeddings[positions, :states.shape[1]] = states
+
+        return embeddings
+
+    def ragged_token_states(self, texts, length=64):
+        texts = list(texts)
+        counts = np.minimum(self.token_lengths(texts), length)
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        flat = np.empty((offsets[-1], self.hidden), dtype=np.float32)
+
+        for positions, states, _ in self.batches(texts, counts):
+            states = states[:, :length].numpy()
+            for row, i in enumerate(positions):
+                flat[offsets[i]:offsets[i + 1]] = states[row, :counts[i]]
+
+        return flat, offsets
+
+    def pooled(self, texts, keyword_starts=None, pooling=('keyword', 'mean')):
+        # (texts x len(pooling) * hidden) fragment vectors: the state of the token at keyword_starts (the character
+        # where the keyword starts in every text) and / or the mean of the states of all the tokens
+        texts = list(texts)
+        embeddings = np.empty((len(texts), len(pooling) * self.hidden), dtype=np.float32)
+
+        for positions, states, encoding in self.batches(texts):
+            mask = encoding['attention_mask']
+            pools = []
+
+            for pool in pooling:
+                if pool == 'keyword':
+                    tokens = [keyword_token(encoding, row, texts[i], int(keyword_starts[i]))
+                              for row, i in enumerate(positions)]
+                    pools.append(states[tt.arange(len(positions)), tt.tensor(tokens)])
+                elif pool == 'mean':
+                    pools.append((states * mask[:, :, None]).sum(dim=1) / mask.sum(dim=1, keepdim=True))
+                else:
+                    raise ValueError(f'unknown pooling {pool}')
+
+            embeddings[positions] = tt.cat(pools, dim=1).numpy()
+
+        return embeddings
+
+
+def keyword_token(encoding, row, text, start):
+    # first token of the keyword starting at character start (skipping characters without a token, like spaces)
+    for char in range(max(start, 0), len(text)):
+        token = encoding.char_to_token(row, char)
+        if token is not None:
+            return token
+
+    return 0
+
+
+def one_at_a_time(embedder, texts, length=64):
+    # the previous per-fragment encoding (with autograd), for comparison
+    out = []
+    for text in texts:
+        emb = embedder.model(tt.tensor([embedder.tokenizer.encode(text)]))[0][0, :length, :]
+
+        pad = tt.zeros((length, embedder.hidden))
+        pad[:emb.size()[0]] = emb
+        out.append(pad)
+
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput of the batched embeddings of the labeled fragments')
+    parser.add_argument('--model', default='bert-base-uncased')
+    parser.add_argument('--limit', type=int, default=2000, help='number of fragments to embed')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--threads', type=int)
+    parser.add_argument('--baseline', type=int, default=200, help='fragments to embed one at a time (0 to skip)')
+    parser.add_argument('--quantized', action='store_true', help='dynamic int8 quantized model')
+    args = parser.parse_args()
+
+    import shared
+    from storage import read_table
+
+    fragments = read_table(op.join(DATA_PROCESSED, 'labeled.csv'), columns=['fragment'])['fragment'].dropna()
+    fragments = fragments.head(args.limit).tolist()
+
+    embedder = Embedder(args.model, args.batch_size, args.threads, quantized=args.quantized)
+
+    start = time.perf_counter()
+    embedder.token_states(fragments)
+    batched = len(fragments) / (time.perf_counter() - start)
+    print(f'batched:      {batched:8.1f} fragments/s (batch size {args.batch_size}, {tt.get_num_threads()} threads)')
+
+    if args.baseline > 0:
+        start = time.perf_counter()
+        one_at_a_time(embedder, fragments[:args.baseline])
+        single = args.baseline / (time.perf_counter() - start)
+        print(f'one at a time: {single:7.1f} fragments/s ({batched / single:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+import hashlib
+import os
+import os.path as op
+
+import numpy as np
+import pandas as pd
+
+# On-disk cache of project embeddings.
+#
+# Every model gets its own directory in the cache, with two files:
+#
+# vectors.f32: the embeddings, one float32 row of dim values after the other, read as a memory-mapped array.
+#
+# index.csv: id, text_hash and row (into vectors.f32) of every cached embedding.
+#
+# An embedding is reused as long as the hash of what was embedded (e.g. the name and the start of the text of the
+# campaign) doesn't change. New or changed campaigns are appended to vectors.f32 and their index entry is replaced,
+# the vectors they replace are left in the file until compact().
+
+
+def text_hash(*parts):
+    return hashlib.md5('\0'.join(parts).encode()).hexdigest()
+
+
+class EmbeddingCache:
+
+    def __init__(self, cache_dir, model_name, dim):
+        self.dir = op.join(cache_dir, model_name.replace('/', '--'))
+        self.model_name = model_name
+        self.dim = dim
+
+        os.makedirs(self.dir, exist_ok=True)
+
+        self.vectors_path = op.join(self.dir, 'vectors.f32')
+        self.index_path = op.join(self.dir, 'index.csv')
+
+        if op.exists(self.index_path):
+            self.index = pd.read_csv(self.index_path, dtype={'id': str, 'text_hash': str, 'row': np.int64})
+        else:
+            self.index = pd.DataFrame({'id': pd.Series(dtype=str), 'text_hash': pd.Series(dtype=str),
+                                       'row': pd.Series(dtype=np.int64)})
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def vectors(self):
+        # memory-mapped (rows x dim) array of every vector in the file
+        rows = op.getsize(self.vectors_path) // (4 * self.dim) if op.exists(self.vectors_path) else 0
+        if rows == 0:
+            return np.zeros((0, self.dim), dtype=np.float32)
+
+        return np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(rows, self.dim))
+
+    def lookup(self, ids, hashes):
+        # row of the cached embedding of every (id, hash), -1 where it isn't cached or the hash changed
+        keys = pd.MultiIndex.from_arrays([self.index['id'], self.index['text_hash']])
+        rows = keys.get_indexer(pd.MultiIndex.from_arrays([list(ids), list(hashes)]))
+
+        found = rows >= 0
+        rows[found] = self.index['row'].values[rows[found]]
+
+        return rows
+
+    def missing(self, ids, hashes):
+        return self.lookup(ids, hashes) < 0
+
+    def get(self, ids, hashes):
+        # (len(ids) x dim) array of the cached embeddings, every one of them has to be cached
+        rows = self.lookup(ids, hashes)
+        if (rows < 0).any():
+            raise KeyError(f'{(rows < 0).sum():,} embeddings are not cached')
+
+        return np.asarray(self.vectors[rows])
+
+    def add(self, ids, hashes, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        start = op.getsize(self.vectors_path) // (4 * self.dim) if op.exists(self.vectors_path) else 0
+
+        # the vectors are written before the index, so an interrupted run never indexes rows that aren't there
+        with open(self.vectors_path, 'ab') as f:
+            f.write(vectors.tobytes())
+
+        added = pd.DataFrame({'id': list(ids), 'text_hash': list(hashes), 'row': np.arange(start, start + len(vectors))})
+        self.index = pd.concat([self.index.loc[~self.index['id'].isin(added['id'])], added], ignore_index=True)
+        self.index = self.index.drop_duplicates('id', keep='last')
+        self.index.to_csv(self.index_path, index=False)
+
+    def compact(self):
+        # rewrite vectors.f32 with only the indexed vectors
+        vectors = np.asarray(self.vectors[self.index['row'].values])
+        with open(self.vectors_path + '.tmp', 'wb') as f:
+            f.write(vectors.tobytes())
+        os.replace(self.vectors_path + '.tmp', self.vectors_path)
+
+        self.index['row'] = np.arange(len(self.index))
+        self.index.to_csv(self.index_path, index=False)
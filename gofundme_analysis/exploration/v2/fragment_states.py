@@ -0,0 +1,153 @@
+import json
+import os
+import os.path as op
+
+import numpy as np
+
+# Precomputed token states of the labeled fragments, stored on disk and read on demand.
+#
+# A store is a directory with:
+#
+# states.bin: the token states of every fragment one after the other, without padding, as a (tokens x hidden) array
+# of float16 (or float32) values.
+#
+# offsets.npy: the states of fragment i are the rows offsets[i]:offsets[i + 1] of states.bin.
+#
+# targets.npy: the metaphorical label of every fragment.
+#
+# meta.json: model (and whether it was int8 quantized), dtype and hidden size of the states; written last, so a store
+# without it is incomplete.
+#
+# Pooled stores (PooledFragments) hold a single vector per fragment instead, in pooled.npy, next to targets.npy and
+# meta.json.
+#
+# states.bin / pooled.npy are memory-mapped the first time a fragment is read, and the mapping isn't pickled, so every
+# DataLoader worker maps the file itself instead of getting a copy of the array.
+
+
+class StateWriter:
+
+    def __init__(self, path, model_name, hidden, dtype='float16', quantized=False):
+        self.path = path
+        self.meta = {'model': model_name, 'quantized': quantized, 'hidden': hidden, 'dtype': dtype}
+        self.offsets = [0]
+        self.targets = []
+
+        os.makedirs(path, exist_ok=True)
+        if op.exists(op.join(path, 'meta.json')):
+            os.remove(op.join(path, 'meta.json'))
+
+        self.file = open(op.join(path, 'states.bin'), 'wb')
+
+    def write(self, states, offsets, targets):
+        # a chunk of fragments, as returned by Embedder.ragged_token_states
+        self.file.write(np.ascontiguousarray(states, dtype=self.meta['dtype']).tobytes())
+        self.offsets.extend(self.offsets[-1] + np.asarray(offsets[1:]))
+        self.targets.extend(targets)
+
+    def close(self):
+        self.file.close()
+
+        np.save(op.join(self.path, 'offsets.npy'), np.array(self.offsets, dtype=np.int64))
+        np.save(op.join(self.path, 'targets.npy'), np.array(self.targets, dtype=bool))
+
+        with open(op.join(self.path, 'meta.json'), 'w') as f:
+            json.dump({**self.meta, 'fragments': len(self.targets), 'tokens': int(self.offsets[-1])}, f, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.close()
+        else:
+            self.file.close()
+
+
+def complete(path):
+    return op.exists(op.join(path, 'meta.json'))
+
+
+class FragmentStates:
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(op.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+
+        self.offsets = np.load(op.join(path, 'offsets.npy'))
+        self.targets = np.load(op.join(path, 'targets.npy'))
+        self.lengths = np.diff(self.offsets)
+        self._states = None
+
+    @property
+    def states(self):
+        if self._states is None:
+            self._states = np.memmap(op.join(self.path, 'states.bin'), dtype=self.meta['dtype'], mode='r',
+                                     shape=(int(self.offsets[-1]), self.meta['hidden']))
+
+        return self._states
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, ix):
+        # (tokens x hidden) float32 states of fragment ix
+        return self.states[self.offsets[ix]:self.offsets[ix + 1]].astype(np.float32)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_states'] = None
+
+        return state
+
+
+def pooled_writer(path, shape, dtype='float32'):
+    # preallocated (fragments x dim) pooled.npy to fill chunk by chunk, the meta.json is written by save_pooled_meta
+    os.makedirs(path, exist_ok=True)
+    if op.exists(op.join(path, 'meta.json')):
+        os.remove(op.join(path, 'meta.json'))
+
+    return np.lib.format.open_memmap(op.join(path, 'pooled.npy'), mode='w+', dtype=dtype, shape=shape)
+
+
+def save_pooled_meta(path, vectors, targets, model_name, pooling, quantized=False):
+    vectors.flush()
+    np.save(op.join(path, 'targets.npy'), np.asarray(targets, dtype=bool))
+
+    with open(op.join(path, 'meta.json'), 'w') as f:
+        json.dump({'model': model_name, 'quantized': quantized, 'pooling': list(pooling), 'dtype': str(vectors.dtype),
+                   'fragments': len(vectors), 'dim': vectors.shape[1]}, f, indent=2)
+
+
+class PooledFragments:
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(op.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+
+        self.targets = np.load(op.join(path, 'targets.npy'))
+        self.dim = self.meta['dim']
+        self._vectors = None
+
+    @property
+    def vectors(self):
+        if self._vectors is None:
+            self._vectors = np.load(op.join(self.path, 'pooled.npy'), mmap_mode='r')
+
+        return self._vectors
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, ix):
+        return self.vectors[ix].astype(np.float32)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_vectors'] = None
+
+        return state
@@ -0,0 +1,177 @@
+import argparse
+import json
+import os
+import os.path as op
+import time
+
+import numpy as np
+
+import torch as tt
+
+import shared
+from storage import csv_path, read_chunks, use_parquet
+
+from embedder import Embedder
+from model import PADDING, Classifier, PooledClassifier, checkpoint_path
+
+# Metaphoricity of every keyword candidate, scored with a classifier trained by model.py.
+#
+# The candidates are read chunk by chunk and embedded like the training fragments, with the tokenization of the next
+# batches running in a thread while the model runs (see Embedder.batches). By default they are labeled.csv followed by
+# data/processed/candidates.csv (the projects extract_keywords.py found that aren't in labeled.csv yet), so the output
+# covers every project. Every scored chunk is appended to the output, in the schema of labeled.csv plus:
+#
+# probability: the predicted probability that the keyword is used metaphorically, empty for the 'none' rows.
+#
+# metaphorical is set to probability >= threshold (or kept where a fragment already has a manual label, with
+# --keep-manual), so the output can replace labeled.csv in the feature pipeline, e.g.
+#
+#   python exploration/v2/infer.py --checkpoint metaphor_pooled.pt --keep-manual
+#   python preprocessing/pipeline.py --sources gofundme --labeled data/processed/predicted.csv
+#
+# After every chunk the number of candidates done and the size of the output are saved in <out>.progress.json. A run
+# that is interrupted picks up after the last saved chunk (the output is cut back to the saved size first), unless
+# --restart is given.
+
+DATA_PROCESSED = '../../data/processed'
+
+# the manually labeled fragments, then the candidates of the projects that aren't labeled yet
+CANDIDATES = [op.join(DATA_PROCESSED, 'labeled.csv'), op.join(DATA_PROCESSED, 'candidates.csv')]
+
+
+class Scorer:
+
+    def __init__(self, checkpoint, batch_size=32, threads=None, prefetch=2):
+        saved = tt.load(checkpoint)
+
+        self.mode = saved["mode"]
+        self.pooling = saved["pooling"]
+
+        self.classifier = Classifier() if self.mode == 'tokens' else PooledClassifier(saved["dim"])
+        self.classifier.load_state_dict(saved["state_dict"])
+        self.classifier.eval()
+
+        # the fragments are embedded like the ones the classifier was trained on
+        self.embedder = Embedder(saved["model_name"], batch_size=batch_size, threads=threads, prefetch=prefetch,
+                                 quantized=saved.get("quantized", False))
+
+    def __call__(self, fragments, keyword_starts):
+        # predicted probability of every fragment
+        if self.mode == 'tokens':
+            embeddings = self.embedder.token_states(fragments, length=PADDING)
+        else:
+            embeddings = self.embedder.pooled(fragments, keyword_starts, self.pooling)
+
+        with tt.inference_mode():
+            return tt.sigmoid(self.classifier(tt.from_numpy(embeddings))).numpy()
+
+
+def progress_path(out_path):
+    return out_path + '.progress.json'
+
+
+def load_progress(out_path, restart=False):
+    # (candidates already scored, size of the output they fill), after cutting the output back to that size
+    if restart or not op.exists(progress_path(out_path)):
+        if op.exists(out_path):
+            os.remove(out_path)
+        return 0, 0
+
+    with open(progress_path(out_path)) as f:
+        progress = json.load(f)
+
+    with open(out_path, 'ab') as f:
+        f.truncate(progress['bytes'])
+
+    return progress['rows'], progress['bytes']
+
+
+def save_progress(out_path, rows, size, finished=False):
+    with open(progress_path(out_path) + '.tmp', 'w') as f:
+        json.dump({'rows': rows, 'bytes': size, 'finished': finished}, f)
+    os.replace(progress_path(out_path) + '.tmp', progress_path(out_path))
+
+
+def read_candidates(paths, chunk_size):
+    # the chunks of every candidates file in turn; files that don't exist (no candidates.csv yet) are skipped
+    for path in paths:
+        if not (use_parquet(path) or op.exists(csv_path(path))):
+            print(f"No candidates in {path}, skipping it")
+            continue
+
+        yield from read_chunks(path, chunk_size)
+
+
+def score_chunk(scorer, chunk, threshold=0.5, keep_manual=False):
+    chunk = chunk.copy()
+    has_text = chunk['fragment'].notna().values
+
+    chunk['probability'] = np.nan
+    chunk.loc[has_text, 'probability'] = scorer(chunk.loc[has_text, 'fragment'].tolist(),
+                                                chunk.loc[has_text, 'kw_start'].values)
+
+    predicted = (chunk['probability'] >= threshold).astype(object).where(has_text)
+    chunk['metaphorical'] = chunk['metaphorical'].where(chunk['metaphorical'].notna(), predicted) if keep_manual \
+        else predicted
+
+    return chunk
+
+
+def infer(candidates_paths, out_path, checkpoint, chunk_size=1024, threshold=0.5, keep_manual=False, restart=False,
+          **scorer):
+    done, size = load_progress(out_path, restart)
+    if done:
+        print(f"Resuming after {done:,} candidates")
+
+    scorer = Scorer(checkpoint, **scorer)
+
+    seen = 0
+    start = time.perf_counter()
+    scored = 0
+
+    for chunk in read_candidates(candidates_paths, chunk_size):
+        # the candidates scored by a previous run are skipped
+        skip = min(max(done - seen, 0), len(chunk))
+        seen += len(chunk)
+        chunk = chunk.iloc[skip:]
+        if len(chunk) == 0:
+            continue
+
+        chunk = score_chunk(scorer, chunk, threshold, keep_manual)
+
+        with open(out_path, 'a') as f:
+            chunk.to_csv(f, header=size == 0, index=False)
+            f.flush()
+            os.fsync(f.fileno())
+        size = op.getsize(out_path)
+
+        done += len(chunk)
+        scored += chunk['probability'].notna().sum()
+        save_progress(out_path, done, size)
+
+        print(f"{done:,} candidates ({scored / (time.perf_counter() - start):.1f} fragments/s)")
+
+    save_progress(out_path, done, size, finished=True)
+    print(f"Saved the predictions of {done:,} candidates in {out_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Score the metaphoricity of every keyword candidate')
+    parser.add_argument('--candidates', nargs='+', default=CANDIDATES, help='files scored one after the other')
+    parser.add_argument('--out', default=op.join(DATA_PROCESSED, 'predicted.csv'))
+    parser.add_argument('--checkpoint', default=checkpoint_path('tokens'), help='classifier saved by model.py')
+    parser.add_argument('--chunk-size', type=int, default=1024, help='candidates scored between two checkpoints')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--threads', type=int)
+    parser.add_argument('--prefetch', type=int, default=2, help='batches tokenized ahead of the model')
+    parser.add_argument('--threshold', type=float, default=0.5)
+    parser.add_argument('--keep-manual', action='store_true', help='keep the labels the candidates already have')
+    parser.add_argument('--restart', action='store_true', help='ignore the progress of a previous run')
+    args = parser.parse_args()
+
+    infer(args.candidates, args.out, args.checkpoint, args.chunk_size, args.threshold, args.keep_manual, args.restart,
+          batch_size=args.batch_size, threads=args.threads, prefetch=args.prefetch)
+
+
+if __name__ == '__main__':
+    main()
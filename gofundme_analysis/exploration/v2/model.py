@@ -1,85 +1,274 @@
+import argparse
 import os.path as op
+import time
 
 from tqdm import tqdm
 
-import pandas as pd
 import numpy as np
 
-import transformers
-
 import torch as tt
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, Sampler, Subset
+
+import shared
+from labeled_store import read_labeled
+
+from embedder import Embedder
+from fragment_states import FragmentStates, PooledFragments, StateWriter, complete, pooled_writer, save_pooled_meta
 
 DATA_PROCESSED = '../../data/processed'
 
+# the labeled.csv columns the fragments are embedded from
+LABELED = ['fragment', 'kw_start', 'metaphorical']
+
+
+PADDING = 64
+
+
+# BERT token states of the labeled fragments, see fragment_states.py
+FRAGMENT_STATES = op.join(DATA_PROCESSED, 'fragment_states')
+
+
+def precompute_states(path=FRAGMENT_STATES, model_name="bert-base-uncased", dtype='float16', chunk_size=4096,
+                      batch_size=32, threads=None, nrows=None, quantized=False):
+    # embed the fragments of labeled.csv chunk by chunk into a fragment state store
+    embedder = Embedder(model_name, batch_size=batch_size, threads=threads, quantized=quantized)
+
+    data = read_labeled(op.join(DATA_PROCESSED, 'labeled.csv'), LABELED)
+    data = (data if nrows is None else data.head(nrows)).dropna()
+
+    with StateWriter(path, model_name, embedder.hidden, dtype, quantized) as writer:
+        for start in tqdm(range(0, len(data), chunk_size)):
+            chunk = data.iloc[start:start + chunk_size]
+            states, offsets = embedder.ragged_token_states(chunk["fragment"], length=PADDING)
+            writer.write(states, offsets, chunk["metaphorical"].values)
+
+    print(f"Saved the states of {len(data):,} fragments in {path}")
+
 
 class InstancesData(Dataset):
 
-    def encode(self, item):
-        padding = 64
+    def __init__(self, path=FRAGMENT_STATES, **precompute):
+        # the states are only computed if there's no complete store at path yet
+        if not complete(path):
+            precompute_states(path, **precompute)
 
-        emb = self.model(tt.tensor([self.tokenizer.encode(item)]))[0][0, :padding, :]
+        self.states = FragmentStates(path)
+        self.lengths = self.states.lengths
 
-        pad = tt.zeros((padding, 768))
-        pad[:emb.size()[0]] = emb
+        print("Data Loaded")
 
-        return pad
+    def __len__(self):
+        return len(self.states)
 
-    def __init__(self):
-        self.tokenizer = transformers.BertTokenizer.from_pretrained("bert-base-uncased")
-        self.model = transformers.BertModel.from_pretrained("bert-base-uncased")
+    def __getitem__(self, ix):
+        return {
+            "embedding": tt.from_numpy(self.states[ix]),
+            "target": tt.as_tensor(self.states.targets[ix])
+        }
 
-        self.data = pd.read_csv(op.join(DATA_PROCESSED, 'labeled.csv'), nrows=100).dropna()
 
-        self.data["embedding"] = self.data["fragment"].apply(self.encode)
+# keyword token + mean pooled BERT states of the labeled fragments, see fragment_states.py
+FRAGMENT_POOLED = op.join(DATA_PROCESSED, 'fragment_pooled')
+
+POOLING = ('keyword', 'mean')
+
+# token states with Classifier, pooled vectors with PooledClassifier
+MODES = ['tokens', 'pooled']
+
+
+def precompute_pooled(path=FRAGMENT_POOLED, model_name="bert-base-uncased", pooling=POOLING, chunk_size=4096,
+                      batch_size=32, threads=None, nrows=None, quantized=False):
+    # one vector per fragment of labeled.csv (the same fragments as precompute_states), see Embedder.pooled
+    embedder = Embedder(model_name, batch_size=batch_size, threads=threads, quantized=quantized)
+
+    data = read_labeled(op.join(DATA_PROCESSED, 'labeled.csv'), LABELED)
+    data = (data if nrows is None else data.head(nrows)).dropna()
+
+    vectors = pooled_writer(path, (len(data), len(pooling) * embedder.hidden))
+    for start in tqdm(range(0, len(data), chunk_size)):
+        chunk = data.iloc[start:start + chunk_size]
+        vectors[start:start + len(chunk)] = embedder.pooled(chunk["fragment"], chunk["kw_start"].values, pooling)
+
+    save_pooled_meta(path, vectors, data["metaphorical"].values, model_name, pooling, quantized)
+    print(f"Saved the pooled vectors of {len(data):,} fragments in {path}")
+
+
+class PooledData(Dataset):
+
+    def __init__(self, path=FRAGMENT_POOLED, **precompute):
+        if not complete(path):
+            precompute_pooled(path, **precompute)
+
+        self.vectors = PooledFragments(path)
+        self.dim = self.vectors.dim
 
         print("Data Loaded")
 
     def __len__(self):
-        return len(self.data)
+        return len(self.vectors)
 
     def __getitem__(self, ix):
         return {
-            "embedding": self.data["embedding"].iloc[ix],
-            "target": tt.as_tensor(self.data["metaphorical"].iloc[ix])
+            "embedding": tt.from_numpy(self.vectors[ix]),
+            "target": tt.as_tensor(self.vectors.targets[ix])
         }
 
 
+class BucketSampler(Sampler):
+    # batches of fragments of similar length: the fragments are sorted by length (in a random order among the ones of
+    # the same length) and cut into batches, which are then visited in a random order
+
+    def __init__(self, lengths, batch_size, shuffle=True, indices=None):
+        # indices: the fragments of the dataset to sample from (all of them by default), lengths are all the lengths
+        self.indices = np.arange(len(lengths)) if indices is None else np.asarray(indices)
+        self.lengths = np.asarray(lengths)[self.indices]
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return int(np.ceil(len(self.lengths) / self.batch_size))
+
+    def __iter__(self):
+        order = np.random.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        order = order[np.argsort(self.lengths[order], kind='stable')]
+
+        order = self.indices[order]
+
+        batches = [order[i:i + self.batch_size].tolist() for i in range(0, len(order), self.batch_size)]
+        for b in np.random.permutation(len(batches)) if self.shuffle else range(len(batches)):
+            yield batches[b]
+
+
+def collate(items):
+    # zero pad the fragments of a batch to the longest one of the batch
+    embeddings = [item["embedding"] for item in items]
+    batch = tt.zeros((len(items), max(len(e) for e in embeddings), embeddings[0].size(1)))
+    for i, e in enumerate(embeddings):
+        batch[i, :len(e)] = e
+
+    return {
+        "embedding": batch,
+        "target": tt.stack([item["target"] for item in items])
+    }
+
+
 class Classifier(nn.Module):
     def __init__(self):
         super(Classifier, self).__init__()
         self.layer1 = nn.Linear(768, 1)
 
     def forward(self, batch):
+        length = batch.size(1)
+
         batch = self.layer1(batch)
         batch = tt.sum(batch, dim=1)
         batch = batch.flatten()
 
-        return batch
+        # the padding tokens missing from a batch shorter than PADDING, so the output is the same as for a batch padded
+        # to PADDING tokens
+        return batch + (PADDING - length) * self.layer1.bias
+
+
+class PooledClassifier(nn.Module):
+    # the same linear model on one pooled vector per fragment
+    def __init__(self, dim=2 * 768):
+        super(PooledClassifier, self).__init__()
+        self.layer1 = nn.Linear(dim, 1)
+
+    def forward(self, batch):
+        return self.layer1(batch).flatten()
+
+
+def store_path(mode, quantized=False):
+    # the int8 embeddings (see embedder.py) are kept apart from the float32 ones
+    path = FRAGMENT_STATES if mode == 'tokens' else FRAGMENT_POOLED
+
+    return path + '_int8' if quantized else path
+
+
+def split(n, test_size=0.2, seed=0):
+    # (test, train) positions; both modes hold the same fragments, so they get the same split
+    order = np.random.default_rng(seed).permutation(n)
+
+    return order[:int(n * test_size)], order[int(n * test_size):]
+
+
+def loaders(mode, batch_size=16, num_workers=0, test_size=0.2, seed=0, quantized=False):
+    # (dataset, train loader, test loader) of a mode
+    path = store_path(mode, quantized)
+    data = InstancesData(path, quantized=quantized) if mode == 'tokens' else PooledData(path, quantized=quantized)
+
+    test, train = split(len(data), test_size, seed)
+
+    # the workers each map the store file, see fragment_states.py
+    if mode == 'tokens':
+        # batches of fragments of similar length, each padded to its longest fragment
+        train = DataLoader(data, batch_sampler=BucketSampler(data.lengths, batch_size, indices=train),
+                           collate_fn=collate, num_workers=num_workers)
+        test = DataLoader(data, batch_sampler=BucketSampler(data.lengths, batch_size, shuffle=False, indices=test),
+                          collate_fn=collate, num_workers=num_workers)
+    else:
+        train = DataLoader(Subset(data, train), batch_size=batch_size, shuffle=True, num_workers=num_workers)
+        test = DataLoader(Subset(data, test), batch_size=batch_size, num_workers=num_workers)
+
+    return data, train, test
 
 
-def train():
+def evaluate(classifier, loader):
+    # (accuracy, fragments per second) of the classifier on the fragments of loader
+    classifier.eval()
+    correct, total = 0, 0
 
-    data = InstancesData()
-    batch_size = 16
-    n_batches = np.ceil(len(data) / batch_size)
+    start = time.perf_counter()
+    with tt.inference_mode():
+        for batch in loader:
+            predicted = classifier(batch["embedding"]) > 0
+            correct += (predicted == batch["target"].bool()).sum().item()
+            total += len(predicted)
 
-    loader = DataLoader(data, shuffle=True, batch_size=batch_size)
+    return correct / max(total, 1), total / (time.perf_counter() - start)
 
-    classifier = Classifier()
+
+def checkpoint_path(mode):
+    return f"metaphor_{mode}.pt"
+
+
+def save_checkpoint(classifier, mode, data, path=None):
+    # the weights with what infer.py needs to embed new fragments the same way
+    meta = data.states.meta if mode == 'tokens' else data.vectors.meta
+
+    tt.save({
+        "mode": mode,
+        "model_name": meta["model"],
+        "quantized": meta.get("quantized", False),
+        "pooling": meta.get("pooling"),
+        "dim": getattr(data, "dim", 768),
+        "state_dict": classifier.state_dict(),
+    }, checkpoint_path(mode) if path is None else path)
+
+
+def train(mode='tokens', num_workers=0, epochs=4, quantized=False):
+    # mode: tokens (Classifier on the token states) or pooled (PooledClassifier on the pooled vectors)
+    data, loader, test = loaders(mode, num_workers=num_workers, quantized=quantized)
+    n_batches = len(loader)
+
+    classifier = Classifier() if mode == 'tokens' else PooledClassifier(data.dim)
     optimizer = tt.optim.Adam(classifier.parameters())
 
     print("Start Training")
 
-    for epoch in range(4):
+    seconds, fragments = 0.0, 0
+
+    for epoch in range(epochs):
 
         classifier.train()
 
         t_loss = tt.zeros(1)
 
         pbar = tqdm(total=n_batches)
+        start = time.perf_counter()
 
         for i_batch, batch in enumerate(loader):
             optimizer.zero_grad()
@@ -96,10 +285,12 @@ def train():
             loss.backward()
             optimizer.step()
 
+            fragments += len(true)
             pbar.update()
 
             del output, logits, true, loss
 
+        seconds += time.perf_counter() - start
         pbar.close()
 
         tl = t_loss.item() / (i_batch + 1)
@@ -108,6 +299,41 @@ def train():
 
     print("Training Finished")
 
+    save_checkpoint(classifier, mode, data)
+    print(f"Model Saved in {checkpoint_path(mode)}")
+
+    accuracy, inference = evaluate(classifier, test)
+    print(f"Test accuracy: {accuracy:.4f}")
+
+    return {'mode': mode, 'train_per_second': fragments / seconds, 'inference_per_second': inference,
+            'accuracy': accuracy}
+
+
+def compare(num_workers=0, epochs=4, quantized=False):
+    # train both modes on the same split and report them side by side
+    results = [train(mode, num_workers, epochs, quantized) for mode in MODES]
+
+    print(f"{'mode':<8} {'train/s':>10} {'inference/s':>12} {'accuracy':>9}")
+    for r in results:
+        print(f"{r['mode']:<8} {r['train_per_second']:10.1f} {r['inference_per_second']:12.1f} {r['accuracy']:9.4f}")
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Train the metaphoricity classifier on the labeled fragments')
+    parser.add_argument('--mode', choices=MODES + ['compare'], default='tokens',
+                        help='token states, pooled vectors, or both side by side')
+    parser.add_argument('--workers', type=int, default=0, help='DataLoader workers')
+    parser.add_argument('--epochs', type=int, default=4)
+    parser.add_argument('--quantized', action='store_true', help='embed the fragments with the int8 quantized model')
+    args = parser.parse_args()
+
+    if args.mode == 'compare':
+        compare(args.workers, args.epochs, args.quantized)
+    else:
+        train(args.mode, args.workers, args.epochs, args.quantized)
+
 
 if __name__ == '__main__':
-    train()
+    main()
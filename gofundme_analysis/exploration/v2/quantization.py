@@ -0,0 +1,177 @@
+import argparse
+import gc
+import io
+import json
+import os.path as op
+import time
+
+import numpy as np
+import pandas as pd
+
+import torch as tt
+
+import shared
+from labeled_store import read_labeled
+from storage import read_table
+
+from embedder import Embedder
+from model import DATA_PROCESSED, LABELED, PADDING, Classifier, PooledClassifier, checkpoint_path, split
+
+# The int8 quantized encoders (Embedder(quantized=True), see embedder.py) against the float32 ones, on CPU.
+#
+# For both precisions the fragments of the held-out slice of labeled.csv (the test positions of model.split, which the
+# classifier never saw) are embedded, and reported side by side:
+#
+# load: seconds to load the model (the first int8 load quantizes and saves it, later ones read the saved model).
+#
+# size: bytes of the serialized weights, and the growth of the process memory while loading the model.
+#
+# fragments/s: embedding throughput.
+#
+# accuracy: of the classifier saved by model.py (metaphor_tokens.pt or metaphor_pooled.pt) on those embeddings, and
+# agreement: the share of its predictions that are the same as on the float32 embeddings.
+#
+# With --detector, the same for GPT-2 and the detection.py network (det_infer.pt) on the projects of ids.csv. The
+# network was trained on all of them, so only the agreement with float32 is a fair comparison there.
+#
+#   python exploration/v2/quantization.py --checkpoint metaphor_pooled.pt --limit 2000 --threads 4
+
+
+PRECISIONS = [('float32', False), ('int8', True)]
+
+
+def rss_mb():
+    # current resident memory of the process
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * 4096 / 2 ** 20
+    except OSError:
+        return float('nan')
+
+
+def model_mb(model):
+    buffer = io.BytesIO()
+    tt.save(model.state_dict(), buffer)
+
+    return buffer.tell() / 2 ** 20
+
+
+def load(model_name, quantized, batch_size, threads):
+    # (embedder, its measurements)
+    gc.collect()
+    before = rss_mb()
+    start = time.perf_counter()
+    embedder = Embedder(model_name, batch_size=batch_size, threads=threads, quantized=quantized)
+
+    return embedder, {'load_seconds': time.perf_counter() - start, 'model_mb': model_mb(embedder.model),
+                      'rss_mb': rss_mb() - before}
+
+
+def held_out(limit=None, test_size=0.2, seed=0):
+    # the labeled fragments model.py holds out for testing (at most limit of them)
+    data = read_labeled(op.join(DATA_PROCESSED, 'labeled.csv'), LABELED).dropna()
+    test, _ = split(len(data), test_size, seed)
+
+    return data.iloc[np.sort(test)[:limit]]
+
+
+def compare_fragments(checkpoint, limit=None, batch_size=32, threads=None):
+    saved = tt.load(checkpoint)
+    mode = saved["mode"]
+
+    classifier = Classifier() if mode == 'tokens' else PooledClassifier(saved["dim"])
+    classifier.load_state_dict(saved["state_dict"])
+    classifier.eval()
+
+    data = held_out(limit)
+    fragments, keyword_starts = data["fragment"].tolist(), data["kw_start"].values
+    targets = data["metaphorical"].astype(bool).values
+
+    results, reference = [], None
+    for precision, quantized in PRECISIONS:
+        embedder, result = load(saved["model_name"], quantized, batch_size, threads)
+
+        start = time.perf_counter()
+        if mode == 'tokens':
+            embeddings = embedder.token_states(fragments, length=PADDING)
+        else:
+            embeddings = embedder.pooled(fragments, keyword_starts, saved["pooling"])
+        seconds = time.perf_counter() - start
+
+        with tt.inference_mode():
+            predicted = (classifier(tt.from_numpy(embeddings)) > 0).numpy()
+        reference = predicted if reference is None else reference
+
+        results.append({'encoder': f'{saved["model_name"]} ({mode})', 'precision': precision, **result,
+                        'per_second': len(fragments) / seconds, 'accuracy': (predicted == targets).mean(),
+                        'agreement': (predicted == reference).mean()})
+
+        del embedder, embeddings
+
+    return results
+
+
+def compare_detector(weights='det_infer.pt', ids_path='ids.csv', limit=None, batch_size=32, threads=None):
+    # imported here, so the metaphor comparison doesn't need the detector's files
+    from detection import MODEL, Net
+
+    net = Net()
+    net.load_state_dict(tt.load(weights))
+    net.eval()
+
+    ids = pd.read_csv(ids_path).head(limit)
+    projects = read_table(op.join(DATA_PROCESSED, 'gofundme_projects.csv'), columns=['id', 'name', 'text']).dropna()
+    projects = projects.drop_duplicates('id').set_index('id').reindex(ids['id'])
+    names, texts = projects['name'].fillna('').tolist(), projects['text'].fillna('').str[:250].tolist()
+    targets = ids['label'].values
+
+    results, reference = [], None
+    for precision, quantized in PRECISIONS:
+        embedder, result = load(MODEL, quantized, batch_size, threads)
+
+        # not through the embedding cache of detection.py, so the embedding is timed
+        start = time.perf_counter()
+        embeddings = np.concatenate([embedder.last_token(names), embedder.last_token(texts)], axis=1)
+        seconds = time.perf_counter() - start
+
+        with tt.inference_mode():
+            predicted = net(tt.from_numpy(embeddings)).argmax(dim=1).numpy()
+        reference = predicted if reference is None else reference
+
+        results.append({'encoder': f'{MODEL} (detector)', 'precision': precision, **result,
+                        'per_second': len(ids) / seconds, 'accuracy': (predicted == targets).mean(),
+                        'agreement': (predicted == reference).mean()})
+
+        del embedder, embeddings
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the int8 quantized encoders with the float32 ones on CPU')
+    parser.add_argument('--checkpoint', default=checkpoint_path('tokens'), help='classifier saved by model.py')
+    parser.add_argument('--limit', type=int, help='held-out fragments (and detector projects) to compare on')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--threads', type=int)
+    parser.add_argument('--detector', action='store_true', help='also compare GPT-2 with the detection.py network')
+    parser.add_argument('--out', default='quantization.json')
+    args = parser.parse_args()
+
+    results = compare_fragments(args.checkpoint, args.limit, args.batch_size, args.threads)
+    if args.detector:
+        results += compare_detector(limit=args.limit, batch_size=args.batch_size, threads=args.threads)
+
+    print(f"{'encoder':<28} {'precision':<9} {'load s':>7} {'model MB':>9} {'RSS MB':>8} {'items/s':>9} "
+          f"{'accuracy':>9} {'agreement':>10}")
+    for r in results:
+        print(f"{r['encoder']:<28} {r['precision']:<9} {r['load_seconds']:7.1f} {r['model_mb']:9.1f} "
+              f"{r['rss_mb']:8.1f} {r['per_second']:9.1f} {r['accuracy']:9.4f} {r['agreement']:10.4f}")
+
+    with open(args.out, 'w') as f:
+        json.dump([{k: float(v) if isinstance(v, (np.floating, float)) else v for k, v in r.items()} for r in results],
+                  f, indent=2)
+    print(f"Saved in {args.out}")
+
+
+if __name__ == '__main__':
+    main()
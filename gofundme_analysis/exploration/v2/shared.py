@@ -0,0 +1,13 @@
+import os.path as op
+import sys
+
+# The scripts of this directory share the table readers and the labeled store with the feature pipeline
+# (gofundme_analysis/preprocessing). Importing this module first makes those modules importable:
+#
+#   import shared
+#   from storage import read_table
+
+PREPROCESSING = op.normpath(op.join(op.dirname(op.abspath(__file__)), '..', '..', 'preprocessing'))
+
+if PREPROCESSING not in sys.path:
+    sys.path.append(PREPROCESSING)
@@ -0,0 +1,262 @@
+import argparse
+import hashlib
+import json
+import os
+import os.path as op
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from cancer_types import CANCER_TYPES
+from create_features import (gofundme_features, gofundme_weights, kickstarter_features, process_gofundme,
+                             process_kickstarter)
+from extract_keywords import KEYWORDS, KeywordFinder
+from ingest import SCHEMAS
+from instrument import Run, peak_rss_mb
+
+# Benchmarks of the feature pipelines on synthetic campaigns.
+#
+# For every size (number of projects) and metaphor density (share of the words that are metaphor keywords), a corpus
+# of synthetic campaigns is generated together with its labeled.csv (every keyword candidate, 80% of them labeled as
+# metaphorical). The GOFUNDME and KICKSTARTER plans of create_features.py run on it in memory, with an instrument.Run
+# timing every feature, and optionally the whole process_gofundme / process_kickstarter / stim process() runs, reading
+# and writing files. The results are written as JSON so runs of different versions can be compared:
+#
+#   python preprocessing/benchmark.py --sizes 1000 10000 100000 --densities 0.005 0.02 --out bench.json
+#
+# The times come from a plain run of every plan (stages: the per-feature times of its Run). tracemalloc slows
+# Python-heavy code down a lot, so the peak memory a plan allocates (peak_mb) is measured in a second, traced run of
+# it. tracemalloc doesn't see the worker processes (workers > 1); their peak RSS so far is reported as
+# children_peak_rss_mb, like in instrument.py.
+
+FILLER = ['the', 'and', 'to', 'of', 'a', 'in', 'her', 'his', 'was', 'for', 'with', 'we', 'family', 'treatment',
+          'chemo', 'doctors', 'help', 'support', 'thank', 'you', 'so', 'much', 'months', 'hospital', 'surgery',
+          'cancer', 'diagnosed', 'love', 'mom', 'dad', 'life', 'bills', 'insurance', 'strong', 'every', 'day']
+
+METAPHOR_WORDS = [kw for keywords in KEYWORDS.values() for kw in keywords]
+
+STATES = ['Seattle, WA', 'Austin, TX', 'Boston, MA', 'Toronto, ON', 'London', 'Miami, FL']
+
+
+def synthetic_texts(n, density, rng, words=(50, 800)):
+    # one document at a time, as object arrays: a fixed-width string array of the whole corpus would cut the longer
+    # keywords (rollercoaster) to the width of the filler words, and take gigabytes at a million projects
+    filler, keywords = np.array(FILLER, dtype=object), np.array(METAPHOR_WORDS, dtype=object)
+
+    texts = []
+    for i, length in enumerate(rng.integers(words[0], words[1], size=n)):
+        tokens = rng.choice(filler, size=length)
+
+        # sprinkle metaphor keywords and, in some texts, a cancer type
+        metaphors = rng.random(length) < density
+        tokens[metaphors] = rng.choice(keywords, size=metaphors.sum())
+
+        sentences = [' '.join(s) + '.' for s in np.array_split(tokens, max(1, length // 15))]
+        if i % 3 == 0:
+            sentences.insert(0, f'She was diagnosed with {CANCER_TYPES[i % len(CANCER_TYPES)]}.')
+        texts.append(' '.join(sentences))
+
+    return texts
+
+
+def synthetic_gofundme(n, density, seed=0):
+    rng = np.random.default_rng(seed)
+
+    urls = [f'https://www.gofundme.com/synthetic-{seed}-{i}' for i in range(n)]
+    goal = rng.integers(1, 100, size=n) * 500
+
+    return pd.DataFrame({
+        'url': urls,
+        'name': [f'Campaign {i}' for i in range(n)],
+        'text': synthetic_texts(n, density, rng),
+        'usd_pledged': (goal * rng.random(n) * 1.5).round(2),
+        'backers': rng.integers(0, 300, size=n),
+        'goal': goal,
+        'launched': pd.Timestamp('2018-01-01') + pd.to_timedelta(rng.integers(0, 400, size=n), unit='D'),
+        'location': rng.choice(STATES, size=n),
+        'shares': [f'{s / 1000:.1f}k' if s > 1000 else str(s) for s in rng.integers(0, 3000, size=n)],
+    })
+
+
+def synthetic_kickstarter(n, density, seed=0):
+    rng = np.random.default_rng(seed)
+    data = synthetic_gofundme(n, density, seed)
+
+    launched = rng.integers(1300000000, 1550000000, size=n)
+    duration = rng.integers(15, 60, size=n) * 24 * 60 * 60
+
+    data['url'] = [f'https://www.kickstarter.com/projects/synthetic-{seed}-{i}' for i in range(n)]
+
+    return pd.DataFrame({
+        'id': np.arange(n), 'name': data['name'], 'blurb': 'A book about my journey through cancer',
+        'created': launched - 10 ** 6, 'launched': launched, 'deadline': launched + duration, 'goal': data['goal'],
+        'spotlight': rng.random(n) < 0.5, 'staff_pick': rng.random(n) < 0.1,
+        'status': rng.choice(['successful', 'failed', 'canceled'], size=n), 'status_changed_at': launched + duration,
+        'backers': data['backers'], 'usd_pledged': data['usd_pledged'], 'pledged': data['usd_pledged'],
+        'currency': 'USD', 'current_currency': 'USD', 'fx_rate': 1.0,
+        'category': rng.choice(['publishing/nonfiction', 'film & video/documentary', 'music', 'art'], size=n),
+        'geo_country': rng.choice(['US', 'CA', 'GB'], size=n), 'geo_state': 'WA', 'geo_type': 'Town',
+        'url': data['url'], 'text': data['text'],
+    })
+
+
+def synthetic_labeled(projects, seed=0):
+    # every keyword candidate of the projects, in the schema of labeled.csv
+    rng = np.random.default_rng(seed)
+    finder = KeywordFinder()
+
+    ids = projects['url'].apply(lambda u: hashlib.md5(str.encode(u)).hexdigest())
+
+    labeled = pd.DataFrame([r for ix, text in zip(ids, projects['text']) for r in finder.find(ix, text)])
+    candidates = labeled['type'] != 'none'
+    # object dtype, so the labels are booleans with NaN for the 'none' rows, like in labeled.csv
+    labeled['metaphorical'] = pd.Series(np.nan, index=labeled.index, dtype=object)
+    labeled.loc[candidates, 'metaphorical'] = rng.random(candidates.sum()) < 0.8
+
+    return labeled
+
+
+def synthetic_sources(n, density, seed=0):
+    # raw GoFundMe and Kickstarter projects, and the labeled fragments of both
+    gofundme = synthetic_gofundme(n, density, seed)
+    kickstarter = synthetic_kickstarter(n, density, seed)
+    labeled = pd.concat([synthetic_labeled(gofundme, seed), synthetic_labeled(kickstarter, seed)], ignore_index=True)
+
+    return gofundme, kickstarter, labeled
+
+
+def measure(func, name, rows):
+    # (result of func(run), its wall / CPU time, the stages of the run and the peak traced memory); the memory comes
+    # from a second run of func
+    run = Run(name, verbose=False)
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = func(run)
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+
+    tracemalloc.start()
+    func(Run(name, verbose=False))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return result, {
+        'rows': rows,
+        'wall_seconds': wall,
+        'cpu_seconds': cpu,
+        'peak_mb': peak / 2 ** 20,
+        'children_peak_rss_mb': peak_rss_mb('children'),
+        'stages': list(run.stages.values()),
+    }
+
+
+def benchmark_plans(n, density, workers=1, seed=0):
+    # the feature plans of create_features.py on the typed synthetic projects, without reading or writing files
+    gofundme, kickstarter, labeled = synthetic_sources(n, density, seed)
+    gofundme = SCHEMAS['gofundme'].apply(gofundme)
+    kickstarter = SCHEMAS['kickstarter'].apply(kickstarter)
+
+    def gofundme_plan(run):
+        with run.stage('weights', len(labeled)):
+            weights = gofundme_weights(labeled)
+
+        return gofundme_features(gofundme.copy(), labeled, weights, workers=workers, run=run)
+
+    plans = {}
+    _, plans['gofundme'] = measure(gofundme_plan, 'gofundme', n)
+    _, plans['kickstarter'] = measure(
+        lambda run: kickstarter_features(kickstarter.copy(), labeled, workers=workers, run=run), 'kickstarter', n)
+
+    return {'labeled_rows': len(labeled), 'plans': plans}
+
+
+def benchmark_pipelines(n, density, workers=1, seed=0):
+    # run the real pipelines on synthetic files in a temporary working directory
+    from pipeline import import_stim
+
+    stim_language_feature_comparisons = import_stim()
+
+    gofundme, kickstarter, labeled = synthetic_sources(n, density, seed)
+
+    pipelines = {}
+    cwd = os.getcwd()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for d in ['data/raw', 'data/processed', 'src/reports']:
+            os.makedirs(op.join(tmp, d))
+
+        gofundme.to_csv(op.join(tmp, 'data/raw/gofundme_projects.csv'), index=False)
+        kickstarter.to_csv(op.join(tmp, 'data/raw/kickstarter_projects.csv'), index=False)
+        labeled.to_csv(op.join(tmp, 'data/processed/labeled.csv'), index=False)
+
+        stim = gofundme[['url', 'name', 'text']].copy()
+        stim['id'] = stim['url'].apply(lambda u: hashlib.md5(str.encode(u)).hexdigest())
+        stim.to_csv(op.join(tmp, 'src/reports/projects.csv'), index=False)
+        labeled.to_csv(op.join(tmp, 'src/reports/labeled.csv'), index=False)
+
+        os.chdir(tmp)
+        try:
+            for name, process in [('process_gofundme', process_gofundme),
+                                  ('process_kickstarter', process_kickstarter),
+                                  ('stim_process', stim_language_feature_comparisons.process)]:
+                _, pipelines[name] = measure(lambda run: process(workers=workers, run=run), name, n)
+        finally:
+            os.chdir(cwd)
+
+    return pipelines
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=op.dirname(op.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the feature pipelines on synthetic campaigns')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--densities', type=float, nargs='+', default=[0.01])
+    parser.add_argument('--pipelines', action='store_true', help='also time the full pipelines')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='benchmark.json')
+    args = parser.parse_args()
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'workers': args.workers,
+        'runs': [],
+    }
+
+    for n in args.sizes:
+        for density in args.densities:
+            print(f'{n:,} projects, metaphor density {density}')
+
+            run = {'projects': n, 'density': density}
+            run.update(benchmark_plans(n, density, args.workers, args.seed))
+            if args.pipelines:
+                run['pipelines'] = benchmark_pipelines(n, density, args.workers, args.seed)
+
+            for name, result in {**run['plans'], **run.get('pipelines', {})}.items():
+                print(f"  {name:<32} {result['wall_seconds']:9.3f} s {result['peak_mb']:9.1f} MB")
+                for stage in result['stages']:
+                    print(f"    {stage['name']:<30} {stage['wall_seconds']:9.3f} s")
+
+            report['runs'].append(run)
+
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(f'Saved benchmark results in {args.out}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+# Find the cancer types mentioned in the project texts.
+#
+# All the terms are compiled into a single regex shaped like a trie of the terms and wrapped in a lookahead, so every
+# text is lowercased once and scanned once, and the cost of a scan grows with the length of the text rather than with
+# the number of terms. At every position the regex takes the longest term; the shorter terms it starts with are
+# counted from a precomputed prefix table, so overlapping terms (e.g. "lymphoma" inside "b-cell lymphoma") are all
+# found, just like separate substring searches would.
+#
+# cancer_type: "unknown" for missing texts, "general" if no type is mentioned, the type if exactly one is, and
+# "mixed" otherwise.
+#
+# <type>_hits: number of times the type is mentioned (the cancer_type_hits feature, see features.py).
+
+CANCER_TYPES = ["breast cancer", "lung cancer", "leukemia", "prostate cancer", "melanoma",
+                "lymphoma", "bone cancer", "skin cancer", "bladder cancer", "kidney cancer",
+                "brain cancer", "liver cancer", "pancreatic cancer", "testicular cancer",
+                "colon cancer", "cervical cancer", "esophageal cancer", "neuroblastoma"]
+
+
+def _trie_pattern(trie):
+    # regex matching the longest path through the trie that ends on a term
+    branches = [re.escape(c) + _trie_pattern(child) for c, child in sorted(trie.items()) if c]
+
+    if not branches:
+        return ''
+
+    pattern = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+
+    # a term ends here, so the rest is optional (and greedy, to prefer longer terms)
+    if '' in trie:
+        pattern = '(?:' + pattern + ')?'
+
+    return pattern
+
+
+class TermMatcher:
+
+    def __init__(self, terms):
+        self.terms = [t.lower() for t in terms]
+        self.index = {t: i for i, t in enumerate(self.terms)}
+
+        trie = {}
+        for t in self.terms:
+            node = trie
+            for c in t:
+                node = node.setdefault(c, {})
+            node[''] = {}
+
+        self.pattern = re.compile('(?=(' + _trie_pattern(trie) + '))')
+
+        # every term found at a position also means all the shorter terms it starts with were found there
+        self.prefixes = {t: [self.index[p] for p in self.terms if t.startswith(p)] for t in self.terms}
+
+    def counts(self, text):
+        # number of occurrences of every term in text
+        counts = np.zeros(len(self.terms), dtype=int)
+
+        for m in self.pattern.finditer(text.lower()):
+            counts[self.prefixes[m.group(1)]] += 1
+
+        return counts
+
+    def label(self, text):
+        if not isinstance(text, str):
+            return "unknown"
+
+        found = np.flatnonzero(self.counts(text))
+
+        if len(found) == 0:
+            return "general"
+        elif len(found) == 1:
+            return self.terms[found[0]]
+        else:
+            return "mixed"
+
+
+cancer_matcher = TermMatcher(CANCER_TYPES)
+
+
+def get_cancer_type(text):
+    return cancer_matcher.label(text)
+
+
+def cancer_types(texts, matcher=cancer_matcher):
+    return pd.Series([matcher.label(t) for t in texts], index=texts.index)
+
+
+def hit_columns(terms):
+    return [re.sub(r'\W+', '_', t.lower()) + '_hits' for t in terms]
+
+
+def cancer_type_counts(texts, matcher=cancer_matcher):
+    # one <term>_hits column per term with the number of times it is mentioned (0 for missing texts)
+    counts = np.zeros((len(texts), len(matcher.terms)), dtype=int)
+
+    for i, t in enumerate(texts):
+        if isinstance(t, str):
+            counts[i] = matcher.counts(t)
+
+    return pd.DataFrame(counts, columns=hit_columns(matcher.terms), index=texts.index)
@@ -1,11 +1,19 @@
+import argparse
 import pandas as pd
 import numpy as np
-import hashlib
+import os.path as op
 import re
 from tqdm import tqdm
-import nltk
-from nltk.tokenize import RegexpTokenizer
-tokenizer = RegexpTokenizer(r'\w+')
+
+from features import FEATURES, Plan, Registry, project_ids
+from incremental import run_cached
+from ingest import fill_missing, per_unique, read_raw, read_raw_chunks, us_locations
+from labeled_store import read_labeled
+from instrument import INSTRUMENT_ENV, PROFILE_ENV, Run
+from metaphors import LABELED_FEATURE_COLUMNS, metaphorical
+from rarity import KeywordWeights, keyword_counts, sum_keyword_counts, weights_path
+from storage import TableWriter, read_chunks, write_table
+from text_length import text_lengths
 
 # Create features related to metaphor usage in each project.
 #
@@ -18,11 +26,6 @@ tokenizer = RegexpTokenizer(r'\w+')
 # *_rare: see code or Jupyter Notebook
 
 
-STATE_ABRV = ['AL', 'AK', 'AZ', 'AR', 'CA', 'CO', 'CT', 'DC', 'DE', 'FL', 'GA', 'HI', 'ID', 'IL', 'IN', 'IA', 'KS',
-              'KY', 'LA', 'ME', 'MD', 'MA', 'MI', 'MN', 'MS', 'MO', 'MT', 'NE', 'NV', 'NH', 'NJ', 'NM', 'NY', 'NC',
-              'ND', 'OH', 'OK', 'OR', 'PA', 'RI', 'SC', 'SD', 'TN', 'TX', 'UT', 'VT', 'VA', 'WA', 'WV', 'WI', 'WY']
-
-
 def get_parent_category(tag):
     if '/' in tag:
         return tag.split('/')[0]
@@ -43,163 +46,92 @@ def merge_negligible_categories(cate):
     return cate
 
 
-CANCER_TYPES = ["breast cancer", "lung cancer", "leukemia", "prostate cancer", "melanoma",
-                 "lymphoma", "bone cancer", "skin cancer", "bladder cancer", "kidney cancer",
-                 "brain cancer", "liver cancer", "pancreatic cancer", "testicular cancer",
-                 "colon cancer", "cervical cancer", "esophageal cancer", "neuroblastoma"]
+KICKSTARTER_FEATURES = Registry(FEATURES)
 
 
-def get_cancer_type(text):
-    ts = []
+@KICKSTARTER_FEATURES.register('pledged_to_goal', ['pledged', 'goal'])
+def kickstarter_pledged_to_goal(pledged, goal):
+    return pledged / goal
 
-    if isinstance(text, float):
-        return "unknown"
 
-    for t in CANCER_TYPES:
-        if t in text.lower():
-            ts.append(t)
+# the dates are parsed by ingest.py
+@KICKSTARTER_FEATURES.register('duration_float', ['deadline', 'launched'])
+def kickstarter_duration(deadline, launched):
+    # data['duration'] = data['deadline'] - data['launched']
+    return (deadline - launched).dt.total_seconds() / (60 * 60 * 24)
 
-    if len(ts) == 0:
-        return "general"
-    elif len(ts) == 1:
-        return ts[0]
-    else:
-        return "mixed"
 
+@KICKSTARTER_FEATURES.register(['month', 'day_of_week', 'year'], ['launched'])
+def kickstarter_launch_date(launched):
+    return launched.dt.month, launched.dt.dayofweek, launched.dt.year
 
-def process_kickstarter():
 
-    print('Processing Kickstarter Projects')
+@KICKSTARTER_FEATURES.register(['from_US', 'from_Town'], ['geo_country', 'geo_type'])
+def kickstarter_location(geo_country, geo_type):
+    return (geo_country == 'US').astype(int), (geo_type == 'Town').astype(int)
 
-    pbar = tqdm(total=20)
 
-    labeled = pd.read_csv('data/processed/labeled.csv')
-    data = pd.read_csv('data/raw/kickstarter_projects.csv')
-    pbar.update()
+@KICKSTARTER_FEATURES.register('category', ['category'])
+def kickstarter_category(category):
+    return per_unique(category, lambda c: c.apply(get_parent_category).apply(merge_negligible_categories))
 
-    data['id'] = data['url'].apply(lambda u: hashlib.md5(str.encode(u)).hexdigest())
-    pbar.update()
 
-    data['usd_pledged'] = data['usd_pledged'].astype(float)
-    pbar.update()
+@KICKSTARTER_FEATURES.register('blurb_length_words', ['blurb', 'workers', 'fast_words'])
+def blurb_length(blurb, workers, fast_words):
+    return text_lengths(blurb, sentences=False, fast=fast_words, workers=workers)['text_length_words']
 
-    data['mean_donation'] = data['usd_pledged'] / data['backers']
-    data['mean_donation'] = data['mean_donation'].fillna(0)
-    pbar.update()
-    data['text_length_words'] = data['text'].apply(lambda t: len(tokenizer.tokenize(t)) if isinstance(t, str) else 0)
-    data['text_length_sentences'] = data['text'].apply(
-        lambda t: len(nltk.sent_tokenize(t)) if isinstance(t, str) else 0
-    )
-    pbar.update()
-    data['pledged_to_goal'] = data['pledged'] / data['goal']
-    pbar.update()
-    # data['duration'] = data['deadline'] - data['launched']
-    data['duration_float'] = (data['deadline'] - data['launched']) / (60 * 60 * 24)
-    pbar.update()
-    data['month'] = pd.to_datetime(data['launched'], unit='s').dt.month
-    data['day_of_week'] = pd.to_datetime(data['launched'], unit='s').dt.dayofweek
-    data['year'] = pd.to_datetime(data['launched'], unit='s').dt.year
-    pbar.update()
-    data['from_US'] = data['geo_country'].apply(lambda x: 1 if x == 'US' else 0)
-    data['from_Town'] = data['geo_type'].apply(lambda x: 1 if x == 'Town' else 0)
-    pbar.update()
-    data['category'] = data['category'].apply(get_parent_category)
-    data['category'] = data['category'].apply(merge_negligible_categories)
-    pbar.update()
-    data['blurb_length_words'] = data['blurb'].apply(lambda t: len(tokenizer.tokenize(t)) if isinstance(t, str) else 0)
-    pbar.update()
-    data['cancer_type'] = data['text'].apply(get_cancer_type)
-    pbar.update()
-    data.drop('status_changed_at', axis=1, inplace=True)
-
-    data['launched'] = pd.to_datetime(data['launched'], unit='s')
-    data['deadline'] = pd.to_datetime(data['deadline'], unit='s')
-    data['created'] = pd.to_datetime(data['created'], unit='s')
-    pbar.update()
 
+@KICKSTARTER_FEATURES.register('finished', ['status'], raw=['status'])
+def kickstarter_finished(status):
     # keep only projects labeled as success or failure
-    data = data[data['status'].isin(['successful', 'failed'])]
-    data['status'] = data['status'].apply(lambda r: 1 if r == 'successful' else 0)
-    pbar.update()
-
-    # for every project ID, how many general keywords of type x were labeled for them?
-    data['battle_metaphor'] = data['id'].apply(
-        lambda ix: len(labeled.loc[(labeled['project_id'] == ix) & (labeled['type'] == 'battle') & (labeled['metaphorical'] == True)])
-    )
-    pbar.update()
-    data['journey_metaphor'] = data['id'].apply(
-        lambda ix: len(labeled.loc[(labeled['project_id'] == ix) & (labeled['type'] == 'journey') & (labeled['metaphorical'] == True)])
-    )
-    pbar.update()
-    # for every project ID, how many specific keywords of type x were labeled for them?
-    data['battle_uniques'] = data['id'].apply(
-        lambda ix: len(set(labeled.loc[(labeled['project_id'] == ix) & (labeled['type'] == 'battle') & (labeled['metaphorical'] == True), 'keyword']))
-    )
-    pbar.update()
-    data['journey_uniques'] = data['id'].apply(
-        lambda ix: len(set(labeled.loc[(labeled['project_id'] == ix) & (labeled['type'] == 'journey') & (labeled['metaphorical'] == True), 'keyword']))
-    )
-    pbar.update()
-
-    # see the comments at the top for a description on these variables
-    data['battle_salience'] = data['battle_metaphor'] / data['text_length_words']
-    data['journey_salience'] = data['journey_metaphor'] / data['text_length_words']
-    pbar.update()
-
-    def first_earliness(id):
-        locs = labeled.loc[(labeled['project_id'] == id) & (labeled['metaphorical'] == True), 'char_location'].values
-        if locs.any() and data.loc[data['id'] == id, 'text'].any():
-            return locs.min() / (len(data.loc[data['id'] == id, 'text'].values[0]) + 1)
-
-        return -1
-
-    # data['first_early'] = data['id'].apply(first_earliness)
-    # pbar.update()
-
-    battle_vc = labeled.dropna().loc[(labeled['type'] == 'battle') & (labeled['metaphorical'] == True), 'keyword'].value_counts()
-    journey_vc = labeled.dropna().loc[(labeled['type'] == 'journey') & (labeled['metaphorical'] == True), 'keyword'].value_counts()
-
-    r = 0.4
-
-    battle_freq_map = (sum(battle_vc) / battle_vc) ** r
-    battle_freq_map = dict(battle_freq_map / min(battle_freq_map))
-
-    journey_freq_map = (sum(journey_vc) / journey_vc) ** r
-    journey_freq_map = dict(journey_freq_map / min(journey_freq_map))
-
-    rarities = []
-
-    # group by id
-    for i, g in labeled.groupby('project_id'):
-        # get the number of words total for the project text
-        all_words = data.loc[data['id'] == i, 'text_length_words']
-
-        # some (~20) projects don't have data on text body size... potential bug
-        if all_words.size > 0 and all_words.values[0] > 0:
-
-            kw = g.loc[g['type'] == 'battle', 'keyword'].value_counts()
-            s = [battle_freq_map[k] * kw[k] for k in dict(kw) if k in battle_freq_map]
-            battle_div = sum(s)
-
-            kw = g.loc[g['type'] == 'journey', 'keyword'].value_counts()
-            s = [journey_freq_map[k] * kw[k] for k in dict(kw)if k in journey_freq_map]
-            journey_div = sum(s)
+    return status.isin(['successful', 'failed'])
 
-        else:
-            battle_div, journey_div = 0.0, 0.0
 
-        rarities.append([i, battle_div, journey_div])
+@KICKSTARTER_FEATURES.register('status', ['status'])
+def kickstarter_status(status):
+    return (status == 'successful').astype(int)
+
+
+# see features.py for the shared features
+KICKSTARTER = Plan(['id', 'usd_pledged', 'mean_donation', 'text_length_words', 'text_length_sentences',
+                    'pledged_to_goal', 'duration_float', 'month', 'day_of_week', 'year', 'from_US', 'from_Town',
+                    'category', 'blurb_length_words', 'cancer_type', 'status',
+                    'battle_metaphor', 'journey_metaphor', 'battle_uniques', 'journey_uniques',
+                    'battle_salience', 'journey_salience', 'battle_rare', 'journey_rare'],
+                   registry=KICKSTARTER_FEATURES, where=['finished'], drop=['status_changed_at'])
+
 
-    rarities = pd.DataFrame(rarities, columns=['id', 'battle_rare', 'journey_rare'])
-    data = data.merge(rarities, how='left', on='id', validate='one_to_one')
+def kickstarter_features(data, labeled, workers=1, run=None, features=None, fast_words=False):
+    # the features of the raw Kickstarter projects in data (only the KICKSTARTER columns in features, if given), timed
+    # feature by feature in run (see instrument.py); fast_words: see text_length.py
 
-    data['battle_rare'] = data['battle_rare'].fillna(0)
-    data['journey_rare'] = data['journey_rare'].fillna(0)
+    # the Kickstarter keyword rarity is computed over all the labeled fragments, not only the metaphorical ones
+    weights = KeywordWeights.fit(labeled, families=['battle', 'journey'])
+    resources = {'labeled': labeled, 'fragments': labeled, 'keyword_weights': weights, 'fast_words': fast_words}
+    data = KICKSTARTER.select(features).run(data, resources, workers=workers, run=run)
 
-    pbar.update()
+    # some (~20) projects don't have data on text body size... potential bug
+    rare = [c for c in ['battle_rare', 'journey_rare'] if c in data]
+    if rare and 'text_length_words' in data:
+        data.loc[data['text_length_words'] == 0, rare] = 0.0
 
     # division by zero (if say there's none of one type of metaphor) results in NA, just fill it with 0
-    data = data.fillna(0)
+    return fill_missing(data, 0)
+
+
+def process_kickstarter(workers=1, run=None, features=None, fast_words=False, labeled_path='data/processed/labeled.csv',
+                        raw_path='data/raw/kickstarter_projects.csv', out_path='data/processed/kickstarter_projects.csv'):
+
+    print('Processing Kickstarter Projects')
+
+    # per-stage timings and memory, see instrument.py
+    run = Run.from_env('kickstarter') if run is None else run
+
+    with run.stage('read'):
+        labeled = read_labeled(labeled_path, LABELED_FEATURE_COLUMNS)
+        data = read_raw(raw_path, 'kickstarter')
+
+    data = kickstarter_features(data, labeled, workers=workers, run=run, features=features, fast_words=fast_words)
 
     # data['dominant_battle'] = np.array(data['battle_salience'] > data['journey_salience']).astype(int)
     # data['dominant_journey'] = np.array(data['battle_salience'] < data['journey_salience']).astype(int)
@@ -207,7 +139,6 @@ def process_kickstarter():
     #         data['battle_salience'] > 0)).astype(int)
     # data['dominant_neither'] = ((data['battle_salience'] == data['journey_salience']) & (
     #         data['battle_salience'] == 0)).astype(int)
-    # pbar.update()
     #
     # # set a single column to denote the dominant metaphor based on the previous set four columns
     # def merge(row):
@@ -224,197 +155,203 @@ def process_kickstarter():
     #     return 'Unknown'
     #
     # data['dominant'] = data.apply(merge, axis=1)
-    # pbar.update()
 
     data['source'] = 'kickstarter'
 
-    data.to_csv('data/processed/kickstarter_projects.csv', index=False)
-    pbar.close()
-    print('Saved new features in data/processed/kickstarter_projects.csv')
+    with run.stage('write', len(data)):
+        write_table(data, out_path)
+    print(f'Saved new features in {out_path}')
+
+    run.finish()
 
     return data
 
-def process_gofundme():
 
-    print('Processing GoFundMe Projects')
+GOFUNDME_FEATURES = Registry(FEATURES)
 
-    pbar = tqdm(total=20)
 
-    # hour = re.compile(r'^(\d{1,2}) hour(?:s?)$')
-    # day = re.compile(r'^(\d{1,2}) day(?:s?)$')
-    # month = re.compile(r'^(\d{1,2}) month(?:s?)$')
-    #
-    # def durtnum(dur):
-    #     hour_s = hour.search(dur)
-    #     if hour_s:
-    #         return float(hour_s.group(1)) / 24
-    #
-    #     day_s = day.search(dur)
-    #     if day_s:
-    #         return int(day_s.group(1))
-    #
-    #     month_s = month.search(dur)
-    #     if month_s:
-    #         return int(month_s.group(1)) * 30
-    #
-    #     return np.nan
-
-
-    def clean_shares(val):
-        try:
-            return int(val)
-        except:
-            return int(float(val[:-1]) * 1000)
-
-    labeled = pd.read_csv('data/processed/labeled.csv')
-    data = pd.read_csv('data/raw/gofundme_projects.csv').dropna()
-    pbar.update()
-
-    data['id'] = data['url'].apply(lambda u: hashlib.md5(str.encode(u)).hexdigest())
-    pbar.update()
-
-    data['usd_pledged'] = data['usd_pledged'].astype(float)
-    pbar.update()
-
-    data['mean_donation'] = data['usd_pledged'] / data['backers']
-    data['mean_donation'] = data['mean_donation'].fillna(0)
-    pbar.update()
-
-    data = data[data['text'].apply(lambda t: isinstance(t, str))]
-    data['text_length_words'] = data['text'].apply(lambda t: len(tokenizer.tokenize(t)))
-    data = data[data['text_length_words'] > 0]
-    data['text_length_sentences'] = data['text'].apply(
-        lambda t: len(nltk.sent_tokenize(t)) if isinstance(t, str) else 0
-    )
-    pbar.update()
-    data['pledged_to_goal'] = data['usd_pledged'] / data['goal']
-    pbar.update()
-    data['launched'] = pd.to_datetime(data['launched'], infer_datetime_format=True)
-    pbar.update()
-    # last day of scraping Timestamp('2019-02-21 00:00:00')
+@GOFUNDME_FEATURES.register('pledged_to_goal', ['usd_pledged', 'goal'])
+def gofundme_pledged_to_goal(usd_pledged, goal):
+    return usd_pledged / goal
+
+
+# hour = re.compile(r'^(\d{1,2}) hour(?:s?)$')
+# day = re.compile(r'^(\d{1,2}) day(?:s?)$')
+# month = re.compile(r'^(\d{1,2}) month(?:s?)$')
+#
+# def durtnum(dur):
+#     hour_s = hour.search(dur)
+#     if hour_s:
+#         return float(hour_s.group(1)) / 24
+#
+#     day_s = day.search(dur)
+#     if day_s:
+#         return int(day_s.group(1))
+#
+#     month_s = month.search(dur)
+#     if month_s:
+#         return int(month_s.group(1)) * 30
+#
+#     return np.nan
 
-    data['duration_float'] = (pd.Timestamp('2019-02-22 00:00:00') - pd.to_datetime(data['launched'])).dt.total_seconds() / (60 * 60 * 24)
 
-    pbar.update()
-    data['day_of_week'] = pd.to_datetime(data['launched'], infer_datetime_format=True).dt.dayofweek
-    pbar.update()
-    data['from_US'] = data['location'].apply(lambda loc: 1 if set(loc.split()) & set(STATE_ABRV) else 0)
-    data.drop('location', axis=1, inplace=True)
-    pbar.update()
-    data['cancer_type'] = data['text'].apply(get_cancer_type)
-    pbar.update()
+# launched and shares are parsed by ingest.py
+@GOFUNDME_FEATURES.register('duration_float', ['launched'])
+def gofundme_duration(launched):
+    # last day of scraping Timestamp('2019-02-21 00:00:00')
+    return (pd.Timestamp('2019-02-22 00:00:00') - launched).dt.total_seconds() / (60 * 60 * 24)
+
 
-    data['shares'] = data['shares'].apply(clean_shares)
-    pbar.update()
+@GOFUNDME_FEATURES.register('day_of_week', ['launched'])
+def gofundme_day_of_week(launched):
+    return launched.dt.dayofweek
 
-    data['status'] = data['pledged_to_goal'].apply(lambda ptg: 1 if ptg >= 1.0 else 0)
-    pbar.update()
 
-    # for every project ID, how many general keywords of type x were labeled for them?
-    data['force_metaphor'] = data['id'].apply(
-        lambda ix: len(labeled.loc[(labeled['project_id'] == ix) & (labeled['type'] == 'force') & (labeled['metaphorical'] == True)])
-    )
+@GOFUNDME_FEATURES.register('from_US', ['location'])
+def gofundme_from_us(location):
+    return us_locations(location)
 
-    data['battle_metaphor'] = data['id'].apply(
-        lambda ix: len(labeled.loc[(labeled['project_id'] == ix) & (labeled['type'] == 'battle') & (labeled['metaphorical'] == True)])
-    )
-    pbar.update()
-    data['journey_metaphor'] = data['id'].apply(
-        lambda ix: len(labeled.loc[(labeled['project_id'] == ix) & (labeled['type'] == 'journey') & (labeled['metaphorical'] == True)])
-    )
-    pbar.update()
 
-    # for every project ID, how many specific keywords of type x were labeled for them?
-    data['battle_uniques'] = data['id'].apply(
-        lambda ix: len(set(labeled.loc[(labeled['project_id'] == ix) & (labeled['type'] == 'battle') & (labeled['metaphorical'] == True), 'keyword']))
-    )
-    pbar.update()
-    data['journey_uniques'] = data['id'].apply(
-        lambda ix: len(set(labeled.loc[(labeled['project_id'] == ix) & (labeled['type'] == 'journey') & (labeled['metaphorical'] == True), 'keyword']))
-    )
-    pbar.update()
+@GOFUNDME_FEATURES.register('status', ['pledged_to_goal'])
+def gofundme_status(pledged_to_goal):
+    return (pledged_to_goal >= 1.0).astype(int)
 
-    # see the comments at the top for a description on these variables
-    data['battle_salience'] = data['battle_metaphor'] / data['text_length_words']
-    data['journey_salience'] = data['journey_metaphor'] / data['text_length_words']
-    pbar.update()
 
-    def battle_earliness(id):
-        return first_earliness(id, "battle")
+# see features.py for the shared features; the *_rare weights depend on the whole corpus, so they are computed
+# separately (after the incremental cache is merged back)
+GOFUNDME = Plan(['usd_pledged', 'mean_donation', 'text_length_words', 'text_length_sentences', 'pledged_to_goal',
+                 'duration_float', 'day_of_week', 'from_US', 'cancer_type', 'status',
+                 'force_metaphor', 'battle_metaphor', 'journey_metaphor', 'battle_uniques', 'journey_uniques',
+                 'battle_salience', 'journey_salience', 'battle_early', 'journey_early'],
+                registry=GOFUNDME_FEATURES, where=['has_text'], drop=['location'])
 
-    def journey_earliness(id):
-        return first_earliness(id, "journey")
+GOFUNDME_RARITY = Plan(['battle_rare', 'journey_rare'], registry=GOFUNDME_FEATURES)
 
-    def first_earliness(id, family):
-        locs = labeled.loc[(labeled['project_id'] == id) & (labeled['metaphorical'] == True) & (labeled['type'] == family), 'char_location'].values
 
-        # if there's at least one metaphor of the specified family, and there's a campaign to match the id
-        if locs.any() and data.loc[data['id'] == id, 'text'].any():
+def gofundme_weights(labeled, rarity_weights=None):
+    # keyword weights for *_rare, fitted on labeled or reused from the rarity_weights file
+    if rarity_weights is None:
+        return KeywordWeights.fit(labeled, families=['battle', 'journey'])
 
-            # return the relative character location of the first metaphor
-            return locs.min() / (len(data.loc[data['id'] == id, 'text'].values[0]) + 1)
+    return KeywordWeights.load_or_fit(rarity_weights, labeled, families=['battle', 'journey'])
 
-        return -1
 
-    data['battle_early'] = data['id'].apply(battle_earliness)
-    data['journey_early'] = data['id'].apply(journey_earliness)
-    pbar.update()
+def gofundme_features(data, labeled, weights, workers=1, cache=None, run=None, features=None, fast_words=False):
+    # the features of the raw GoFundMe projects in data (only the GOFUNDME / GOFUNDME_RARITY columns in features, if
+    # given), timed feature by feature in run (see instrument.py); fast_words: see text_length.py
+    plan, rarity = GOFUNDME.select(features), GOFUNDME_RARITY.select(features)
 
-    # count the number of instances for each metaphor keyword
-    battle_vc = labeled.dropna().loc[(labeled['type'] == 'battle') & labeled['metaphorical'], 'keyword'].value_counts()
-    journey_vc = labeled.dropna().loc[(labeled['type'] == 'journey') & labeled['metaphorical'], 'keyword'].value_counts()
+    data['id'] = project_ids(data['url'])
+    resources = {'labeled': labeled, 'fast_words': fast_words}
 
-    # set the constant factor exponent
-    r = 0.4
+    # only recompute the projects that are new or changed since the cached run, see incremental.py
+    if cache is not None:
+        data = run_cached(plan, data, labeled, cache, resources, workers=workers, run=run)
+    else:
+        data = plan.run(data, resources, workers=workers, run=run)
 
-    # compute frequency maps
-    battle_freq_map = (sum(battle_vc) / battle_vc) ** r
-    battle_freq_map = dict(battle_freq_map / min(battle_freq_map))
+    data = rarity.run(data, {'labeled': labeled, 'keyword_weights': weights}, workers=workers, run=run)
 
-    journey_freq_map = (sum(journey_vc) / journey_vc) ** r
-    journey_freq_map = dict(journey_freq_map / min(journey_freq_map))
+    data['source'] = 'gofundme'
 
-    rarities = []
+    return data
 
-    # group by id
-    for i, g in labeled.loc[labeled['metaphorical'] == True].groupby('project_id'):
-        # get the number of words total for the project text
-        all_words = data.loc[data['id'] == i, 'text_length_words']
 
-        kw = g.loc[g['type'] == 'battle', 'keyword'].value_counts()
-        s = [battle_freq_map[k] * kw[k] for k in dict(kw) if k in battle_freq_map]
-        battle_div = sum(s)
+def process_gofundme(rarity_weights=None, workers=1, cache=None, run=None, features=None, fast_words=False,
+                     labeled_path='data/processed/labeled.csv', raw_path='data/raw/gofundme_projects.csv',
+                     out_path='data/processed/gofundme_projects.csv'):
 
-        kw = g.loc[g['type'] == 'journey', 'keyword'].value_counts()
-        s = [journey_freq_map[k] * kw[k] for k in dict(kw) if k in journey_freq_map]
-        journey_div = sum(s)
+    print('Processing GoFundMe Projects')
 
-        rarities.append([i, battle_div, journey_div])
+    # per-stage timings and memory, see instrument.py
+    run = Run.from_env('gofundme') if run is None else run
 
-    rarities = pd.DataFrame(rarities, columns=['id', 'battle_rare', 'journey_rare'])
-    data = data.merge(rarities, how='left', on='id', validate='one_to_one')
+    with run.stage('read'):
+        labeled = read_labeled(labeled_path, LABELED_FEATURE_COLUMNS)
+        data = read_raw(raw_path, 'gofundme').dropna()
 
-    data['battle_rare'] = data['battle_rare'].fillna(0)
-    data['journey_rare'] = data['journey_rare'].fillna(0)
+    with run.stage('weights', len(labeled)):
+        weights = gofundme_weights(labeled, rarity_weights)
 
-    pbar.update()
+    data = gofundme_features(data, labeled, weights, workers=workers, cache=cache, run=run, features=features,
+                             fast_words=fast_words)
 
-    data['source'] = 'gofundme'
+    with run.stage('write', len(data)):
+        write_table(data, out_path)
+    print(f'Saved new features in {out_path}')
 
-    data.to_csv('data/processed/gofundme_projects.csv', index=False)
-    pbar.close()
-    print('Saved new features in data/processed/gofundme_projects.csv')
+    run.finish()
 
     return data
 
+
+def chunk_labeled(labeled_path, ids, chunk_size):
+    # the metaphorical labeled rows of the projects ids, read chunk by chunk
+    rows = [chunk.loc[chunk['project_id'].isin(ids)]
+            for chunk in read_chunks(labeled_path, chunk_size, columns=LABELED_FEATURE_COLUMNS)]
+
+    return metaphorical(pd.concat(rows, ignore_index=True))
+
+
+def stream_gofundme(chunk_size=10000, rarity_weights=None, workers=1, run=None, features=None, fast_words=False,
+                    labeled_path='data/processed/labeled.csv', raw_path='data/raw/gofundme_projects.csv',
+                    out_path='data/processed/gofundme_projects.csv'):
+    # process_gofundme for raw files that don't fit in memory: the corpus-level keyword weights come from a first pass
+    # over labeled.csv, then the raw projects are read, processed and appended to the output (CSV and Parquet) chunk by
+    # chunk. The labeled rows of every chunk of projects are picked out of another pass over labeled.csv, so neither
+    # table is ever held in memory as a whole
+
+    print(f'Processing GoFundMe Projects in chunks of {chunk_size:,}')
+
+    # per-stage timings and memory summed over the chunks, see instrument.py
+    run = Run.from_env('gofundme_stream') if run is None else run
+
+    with run.stage('labeled_pass'):
+        counts = [keyword_counts(metaphorical(chunk), families=['battle', 'journey'])
+                  for chunk in read_chunks(labeled_path, chunk_size, columns=LABELED_FEATURE_COLUMNS)]
+
+    with run.stage('weights'):
+        if rarity_weights is not None and op.exists(weights_path(rarity_weights)):
+            weights = KeywordWeights.load(rarity_weights)
+        else:
+            weights = KeywordWeights.from_counts(sum_keyword_counts(counts))
+            if rarity_weights is not None:
+                weights.save(rarity_weights)
+
+    with TableWriter(out_path) as out:
+        for chunk in tqdm(read_raw_chunks(raw_path, 'gofundme', chunk_size)):
+            chunk = chunk.dropna()
+
+            with run.stage('labeled_rows', len(chunk)):
+                labeled = chunk_labeled(labeled_path, project_ids(chunk['url']), chunk_size)
+
+            chunk = gofundme_features(chunk, labeled, weights, workers=workers, run=run, features=features,
+                                      fast_words=fast_words)
+            with run.stage('write', len(chunk)):
+                out.write(chunk)
+
+    print(f'Saved new features of {out.rows:,} projects in {out_path}')
+
+    run.finish()
+
+
 def main():
+    parser = argparse.ArgumentParser(description='Create the metaphor features of the GoFundMe projects')
+    parser.add_argument('--instrument', metavar='DIR',
+                        help=f'save a per-stage run report in DIR (or set {INSTRUMENT_ENV}), see instrument.py')
+    parser.add_argument('--profile', action='store_true', default=None,
+                        help=f'also dump a cProfile of every stage in DIR (or set {PROFILE_ENV}=1)')
+    parser.add_argument('--fast-words', action='store_true',
+                        help='count the words without building token lists, see text_length.py')
+    args = parser.parse_args()
 
     # kickstarter_projs = process_kickstarter()
-    gofundme_projs = process_gofundme()
+    gofundme_projs = process_gofundme(run=Run.from_env('gofundme', args.instrument, args.profile),
+                                      fast_words=args.fast_words)
 
     # combined_projs = pd.concat([kickstarter_projs, gofundme_projs], axis=0, ignore_index=True, sort=False)
     #
-    # combined_projs.to_csv('data/processed/combined_projects.csv', index=False)
+    # write_table(combined_projs, 'data/processed/combined_projects.csv')
     # print('Projects Combined into data/processed/combined_projects.csv')
 
 
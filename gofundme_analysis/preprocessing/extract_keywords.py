@@ -0,0 +1,158 @@
+import argparse
+import os.path as op
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import re
+
+from ingest import url_ids
+
+# Find the metaphor keyword candidates of every campaign, in the schema of data/processed/labeled.csv.
+#
+# This is the search of find_keywords in exploration/extract_metaphors.ipynb: a keyword surrounded by non-word
+# characters, reported with the 80 characters of context on either side. Here every family is compiled into a
+# single alternation, so each text is lowercased and scanned once. Campaigns are searched in chunks over a process
+# pool and the candidates are appended to the output CSV chunk by chunk, with metaphorical left empty for labeling.
+# Campaigns without any keyword get a single 'none' row, like in the notebook.
+#
+# char_location: position of the character before the keyword in the campaign text.
+#
+# kw_start: position of the keyword in the fragment.
+
+BATTLE_WORDS = ['fights', 'fighting', 'fight', 'fought',
+                'battles', 'battled', 'battling', 'battle',
+                'war',
+                'beating', 'beats', 'beaten', 'beat',
+                'enemy',
+                'defeat',
+                'winning', 'win',
+                'combat']
+
+JOURNEY_WORDS = ['path', 'journey', 'road', 'rollercoaster']
+
+FORCE_WORDS = ['forced', 'forcing', 'force',
+               'lava', 'flood', 'volcano', 'waves', 'wave', 'drown', 'storm',
+               'disaster', 'rivers', 'river', 'rain']
+
+KEYWORDS = {'force': FORCE_WORDS, 'battle': BATTLE_WORDS, 'journey': JOURNEY_WORDS}
+
+WINDOW = 80
+
+LABELED_COLUMNS = ['char_location', 'fragment', 'keyword', 'kw_start', 'metaphorical', 'project_id', 'type']
+
+
+class KeywordFinder:
+
+    def __init__(self, families=KEYWORDS, window=WINDOW):
+        self.window = window
+        self.family = {}
+        for family, keywords in families.items():
+            for kw in keywords:
+                self.family.setdefault(kw, family)
+
+        # longest first, so a keyword is never cut short by another one it starts with
+        keywords = sorted(self.family, key=len, reverse=True)
+        self.pattern = re.compile(r'(?<=\W)(' + '|'.join(re.escape(kw) for kw in keywords) + r')(?=\W)')
+
+    def find(self, project_id, text):
+        if not isinstance(text, str):
+            return []
+
+        records = []
+        for kw_match in self.pattern.finditer(text.lower()):
+            location = kw_match.start() - 1
+            start, end = max(0, location - self.window), min(len(text), kw_match.end() + 1 + self.window)
+
+            records.append({'char_location': float(location),
+                            'fragment': text[start:end],
+                            'keyword': kw_match.group(1),
+                            'kw_start': float(kw_match.start() - start),
+                            'metaphorical': np.nan,
+                            'project_id': project_id,
+                            'type': self.family[kw_match.group(1)]})
+
+        if not records:
+            records.append({'project_id': project_id, 'type': 'none'})
+
+        return records
+
+
+def _find_chunk(finder, ids, texts):
+    records = [r for ix, text in zip(ids, texts) for r in finder.find(ix, text)]
+
+    return pd.DataFrame(records, columns=LABELED_COLUMNS)
+
+
+def read_projects(path, chunk_size):
+    # (id, text) chunks of a projects CSV; raw scrapes only have the url, which the id is the md5 of
+    header = pd.read_csv(path, nrows=0).columns
+    columns = ['id', 'text'] if 'id' in header else ['url', 'text']
+
+    for chunk in pd.read_csv(path, usecols=columns, chunksize=chunk_size):
+        if 'id' not in chunk:
+            chunk['id'] = url_ids(chunk['url'])
+
+        yield chunk
+
+
+def extract_keywords(projects_path, out_path, labeled_path=None, finder=None, workers=1, chunk_size=1000):
+    # append the candidates of every project to out_path, skipping the project ids already in labeled_path or out_path
+    finder = KeywordFinder() if finder is None else finder
+
+    seen = set()
+    for path in [labeled_path, out_path]:
+        if path is not None and op.exists(path):
+            seen.update(pd.read_csv(path, usecols=['project_id'])['project_id'])
+
+    def chunks():
+        for chunk in read_projects(projects_path, chunk_size):
+            chunk = chunk.loc[~chunk['id'].isin(seen)].drop_duplicates('id')
+            if len(chunk) > 0:
+                yield chunk
+
+    write_header = not op.exists(out_path)
+    total = 0
+
+    def write(candidates):
+        nonlocal write_header, total
+        candidates.to_csv(out_path, mode='a', header=write_header, index=False)
+        write_header = False
+        total += len(candidates)
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # keep at most 2 chunks per worker in flight, so memory doesn't grow with the corpus
+            pending = []
+            for chunk in chunks():
+                pending.append(pool.submit(_find_chunk, finder, chunk['id'].values, chunk['text'].values))
+                if len(pending) >= 2 * workers:
+                    write(pending.pop(0).result())
+            for future in pending:
+                write(future.result())
+    else:
+        for chunk in chunks():
+            write(_find_chunk(finder, chunk['id'].values, chunk['text'].values))
+
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Find metaphor keyword candidates in the schema of labeled.csv')
+    parser.add_argument('--projects', default='data/processed/combined_projects.csv')
+    parser.add_argument('--out', default='data/processed/candidates.csv')
+    parser.add_argument('--labeled', default='data/processed/labeled.csv',
+                        help='skip the projects already in this file (incremental mode)')
+    parser.add_argument('--all', action='store_true', help='search every project, even if it is already labeled')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    total = extract_keywords(args.projects, args.out, labeled_path=None if args.all else args.labeled,
+                             workers=args.workers, chunk_size=args.chunk_size)
+
+    print(f'Saved {total:,} candidates in {args.out}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,334 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from cancer_types import CANCER_TYPES, cancer_type_counts, cancer_types, hit_columns
+from extract_keywords import KEYWORDS
+from ingest import url_ids
+from metaphors import count_metaphors, metaphorical
+from positions import POSITION_STATS, relative_positions
+from rarity import keyword_scores
+from text_length import text_lengths
+
+# Registry of the project features shared by the Kickstarter, GoFundMe and custom-campaign (stim) pipelines.
+#
+# Every feature is a function registered with the column(s) it outputs and the names of its inputs. An input is
+# either a column of the projects, a resource passed to the run (labeled, keyword_weights, workers, ...) or the output
+# of another feature, so e.g. battle_salience reuses the battle_metaphor column and the word counts of
+# text_length_words, and all the *_metaphor / *_uniques columns come out of a single metaphor_counts table. Features
+# that aren't aligned with the project rows (like metaphor_counts) are registered with rows=False.
+#
+# Resources a run doesn't pass come from DEFAULTS, e.g. fast_words=True counts the words of text_length_words without
+# building token lists (see text_length.py).
+#
+# A Plan lists the columns a source wants. Running it computes only the features these columns need, each one once,
+# and the features that don't depend on each other run concurrently (workers > 1). A feature input that has the same
+# name as the feature's own output (e.g. usd_pledged -> usd_pledged as float), or that is registered as raw, is the raw
+# column. Other inputs use the feature if the plan requests it, otherwise the raw column if the projects have one.
+#
+# Sources register their own features in a Registry(FEATURES), which falls back to the shared features, see
+# create_features.py.
+
+FAMILIES = list(KEYWORDS)
+
+DEFAULTS = {'fast_words': False}
+
+# version of the feature code; change it whenever a feature computes something different, so the incremental caches
+# built with the old code are discarded (see incremental.py)
+VERSION = '1'
+
+
+class Feature:
+
+    def __init__(self, func, outputs, inputs, rows=True, raw=(), name=None):
+        self.func = func
+        # the stage name in the run reports and profiles
+        self.name = func.__name__ if name is None else name
+        self.outputs = outputs
+        self.inputs = inputs
+        self.rows = rows
+        # inputs always read from the columns of the projects
+        self.raw = set(outputs) | set(raw)
+
+    def __repr__(self):
+        return f'Feature({self.name}: {", ".join(self.inputs)} -> {", ".join(self.outputs)})'
+
+
+class Registry:
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.features = {}
+
+    def register(self, outputs, inputs=(), rows=True, raw=(), name=None):
+        # decorator registering func as the feature computing outputs
+        outputs = [outputs] if isinstance(outputs, str) else list(outputs)
+
+        def decorator(func):
+            feature = Feature(func, outputs, list(inputs), rows, raw, name)
+            for output in outputs:
+                self.features[output] = feature
+
+            return func
+
+        return decorator
+
+    def get(self, name):
+        if name in self.features:
+            return self.features[name]
+
+        return self.parent.get(name) if self.parent is not None else None
+
+
+FEATURES = Registry()
+
+
+class Plan:
+
+    def __init__(self, columns, registry=FEATURES, where=(), drop=()):
+        # columns: the features to add to the projects (in this order)
+        # where: boolean features, the projects where any of them is False are dropped before computing the others
+        # drop: raw columns removed from the output
+        self.columns = list(columns)
+        self.registry = registry
+        self.where = list(where)
+        self.drop = list(drop)
+
+        for name in self.columns + self.where:
+            if registry.get(name) is None:
+                raise KeyError(f'no feature computes {name}')
+
+    def dependencies(self, feature, columns, resources):
+        # features whose outputs feature uses as inputs
+        requested = set(self.columns) | set(self.where)
+        deps = []
+
+        for name in feature.inputs:
+            if name in resources or name in feature.raw:
+                continue
+            if name in columns and name not in requested:
+                continue
+            dep = self.registry.get(name)
+            if dep is None:
+                if name in columns:
+                    continue
+                raise KeyError(f'{feature.name} needs {name}, which is neither a column, a resource nor a feature')
+            deps.append(dep)
+
+        return deps
+
+    def levels(self, names, columns, resources, done):
+        # the features needed for names, grouped so every feature only depends on the ones of earlier groups
+        depth = {}
+
+        def visit(feature, path=()):
+            if feature in path:
+                raise ValueError(f'features depend on each other: {" -> ".join(f.name for f in path + (feature,))}')
+            if feature not in depth:
+                deps = [d for d in self.dependencies(feature, columns, resources) if d not in done]
+                depth[feature] = 1 + max([visit(d, path + (feature,)) for d in deps], default=-1)
+
+            return depth[feature]
+
+        for name in names:
+            feature = self.registry.get(name)
+            if feature not in done:
+                visit(feature)
+
+        return [[f for f, d in depth.items() if d == level] for level in range(max(depth.values(), default=-1) + 1)]
+
+    def compute(self, names, data, values, resources, done, workers, run):
+        requested = set(self.columns) | set(self.where)
+
+        def evaluate(feature):
+            # same lookups as dependencies
+            args = []
+            for name in feature.inputs:
+                if name in feature.raw:
+                    args.append(data[name])
+                elif name in resources:
+                    args.append(values[name])
+                elif name in data and (name not in requested or self.registry.get(name) is None):
+                    args.append(data[name])
+                else:
+                    args.append(values[name])
+
+            if run is None:
+                return feature.func(*args)
+            with run.stage(feature.name, len(data)):
+                return feature.func(*args)
+
+        def store(feature, result):
+            if len(feature.outputs) == 1:
+                result = {feature.outputs[0]: result}
+            elif isinstance(result, pd.DataFrame):
+                result = {name: result[name] for name in feature.outputs}
+            else:
+                result = dict(zip(feature.outputs, result))
+
+            for name, value in result.items():
+                if feature.rows and not isinstance(value, pd.Series):
+                    value = pd.Series(value, index=data.index)
+                values[name] = value
+
+            done.add(feature)
+
+        # profiles are per thread, so profiled runs compute one feature at a time
+        concurrent = workers > 1 and not (run is not None and run.profile)
+
+        for level in self.levels(names, data.columns, resources, done):
+            if concurrent and len(level) > 1:
+                with ThreadPoolExecutor(max_workers=min(workers, len(level))) as pool:
+                    for feature, result in zip(level, pool.map(evaluate, level)):
+                        store(feature, result)
+            else:
+                for feature in level:
+                    store(feature, evaluate(feature))
+
+    def select(self, names=None):
+        # the plan computing only the columns in names (all of them if None); the project ids are always kept, the
+        # other features and the combined table are keyed on them
+        if names is None:
+            return self
+
+        names = set(names) | {'id'}
+
+        return Plan([c for c in self.columns if c in names], self.registry, self.where, self.drop)
+
+    def key(self):
+        # what the plan computes: its columns, filters and the feature code version
+        return {'columns': self.columns, 'where': self.where, 'drop': self.drop, 'version': VERSION}
+
+    def run(self, data, resources=None, workers=1, run=None):
+        # data with the plan's columns added (and the where filter applied); run times every feature, see instrument.py
+        values = {'workers': workers, **DEFAULTS, **(resources or {})}
+        resources = set(values)
+        done = set()
+
+        if self.where:
+            self.compute(self.where, data, values, resources, done, workers, run)
+            keep = np.logical_and.reduce([values[name].values.astype(bool) for name in self.where])
+
+            data = data[keep].copy()
+            for feature in done:
+                if feature.rows:
+                    for name in feature.outputs:
+                        values[name] = values[name][keep]
+
+        self.compute(self.columns, data, values, resources, done, workers, run)
+
+        for name in self.columns:
+            data[name] = values[name].values
+
+        return data.drop(columns=self.drop)
+
+
+@FEATURES.register('id', ['url'])
+def project_ids(url):
+    return url_ids(url)
+
+
+@FEATURES.register('usd_pledged', ['usd_pledged'])
+def usd_pledged(usd_pledged):
+    return usd_pledged.astype(float)
+
+
+@FEATURES.register('mean_donation', ['usd_pledged', 'backers'])
+def mean_donation(usd_pledged, backers):
+    return (usd_pledged / backers).fillna(0)
+
+
+@FEATURES.register(['text_length_words', 'text_length_sentences'], ['text', 'workers', 'fast_words'])
+def text_length(text, workers, fast_words):
+    return text_lengths(text, fast=fast_words, workers=workers)
+
+
+@FEATURES.register('has_text', ['text_length_words'])
+def has_text(text_length_words):
+    # non-string texts have 0 words
+    return text_length_words > 0
+
+
+@FEATURES.register('cancer_type', ['text'])
+def cancer_type(text):
+    return cancer_types(text)
+
+
+@FEATURES.register(hit_columns(CANCER_TYPES), ['text'])
+def cancer_type_hits(text):
+    return cancer_type_counts(text)
+
+
+@FEATURES.register('fragments', ['labeled'], rows=False)
+def fragments(labeled):
+    return metaphorical(labeled)
+
+
+@FEATURES.register('metaphor_counts', ['labeled'], rows=False)
+def metaphor_counts(labeled):
+    return count_metaphors(labeled, FAMILIES)
+
+
+@FEATURES.register('metaphor_positions', ['id', 'text', 'labeled'], rows=False)
+def metaphor_positions(id, text, labeled):
+    return relative_positions(pd.DataFrame({'id': id.values, 'text': text.values}), labeled)
+
+
+@FEATURES.register('first_instantiation', ['id', 'metaphor_positions'])
+def first_instantiation(id, metaphor_positions):
+    # relative position of the first metaphor of any family
+    first = metaphor_positions.groupby('project_id', observed=True)['position'].min()
+
+    return first.reindex(id).fillna(-1).values
+
+
+@FEATURES.register('keyword_scores', ['id', 'fragments', 'keyword_weights'], rows=False)
+def keyword_score(id, fragments, keyword_weights):
+    sums, counts = keyword_scores(pd.DataFrame({'id': id.values}), fragments, keyword_weights)
+
+    return keyword_weights.families, sums, counts
+
+
+def register_family(family):
+    # the per-family features, see metaphors.py, positions.py and rarity.py for their definitions; every one is named
+    # after its output, so the families are told apart in the run reports and profiles
+
+    def register(output, inputs):
+        return FEATURES.register(output, inputs, name=output)
+
+    @register(family + '_metaphor', ['id', 'metaphor_counts'])
+    def metaphor_count(id, metaphor_counts):
+        return metaphor_counts[family + '_metaphor'].reindex(id).fillna(0).astype(int).values
+
+    @register(family + '_uniques', ['id', 'metaphor_counts'])
+    def unique_count(id, metaphor_counts):
+        return metaphor_counts[family + '_uniques'].reindex(id).fillna(0).astype(int).values
+
+    @register(family + '_salience', [family + '_metaphor', 'text_length_words'])
+    def salience(metaphors, text_length_words):
+        return metaphors / text_length_words
+
+    for stat, reduce in POSITION_STATS.items():
+        @register(f'{family}_{stat}', ['id', 'metaphor_positions'])
+        def position(id, metaphor_positions, reduce=reduce):
+            family_positions = metaphor_positions.loc[metaphor_positions['type'] == family]
+
+            return reduce(family_positions.groupby('project_id', observed=True)['position']).reindex(id).fillna(-1).values
+
+    @register(family + '_rare', ['keyword_scores'])
+    def rarity(keyword_scores):
+        families, sums, _ = keyword_scores
+
+        return sums[:, families.get_loc(family)]
+
+    @register(family + '_prod', ['keyword_scores'])
+    def productivity(keyword_scores):
+        families, sums, counts = keyword_scores
+        f = families.get_loc(family)
+
+        return np.divide(sums[:, f], counts[:, f], out=np.zeros(len(sums)), where=counts[:, f] > 0)
+
+
+for family in FAMILIES:
+    register_family(family)
@@ -0,0 +1,99 @@
+import os.path as op
+
+import numpy as np
+import pandas as pd
+
+# Incremental feature builds.
+#
+# Next to the computed features of every project, the cache keeps two hashes:
+#
+# row_hash: hash of the raw fields of the project (text, goal, shares, ...).
+#
+# labeled_hash: hash of the labeled.csv rows of the project (0 if it has none).
+#
+# On a rerun only the projects that are new or whose hashes changed go through the feature pipeline again; the others
+# are taken from the cache as they are. Features that depend on the whole corpus (like the *_rare weights) are not
+# cached and have to be computed over the merged rows.
+#
+# The cache also keeps the key of the plan it was computed with (its columns and the feature code version, see
+# Plan.key), and the plain resource values it ran with (like fast_words). A cache with another key is discarded as a
+# whole, so changing the plan, the features or their settings rebuilds it.
+
+
+def labeled_hashes(labeled):
+    # order-insensitive hash of the labeled rows of every project id; the values are hashed as plain objects, so the
+    # hashes don't depend on whether labeled.csv was read from the CSV, the Parquet file or the store
+    values = labeled.astype(object)
+    values = values.where(values.notna(), None)
+
+    rows = pd.Series(pd.util.hash_pandas_object(values, index=False).values, index=labeled['project_id'].values)
+
+    return rows.groupby(level=0).sum()
+
+
+def content_hashes(data, labeled, columns=None):
+    columns = list(data.columns) if columns is None else columns
+
+    hashes = pd.DataFrame({'id': data['id'].values})
+    hashes['row_hash'] = pd.util.hash_pandas_object(data[columns], index=False).values
+    hashes['labeled_hash'] = labeled_hashes(labeled).reindex(data['id'], fill_value=0).values
+
+    return hashes
+
+
+def read_cache(path, key):
+    # the cached features, or None if there are none for key
+    if not op.exists(path):
+        return None
+
+    cache = pd.read_pickle(path)
+    if not isinstance(cache, dict) or cache.get('key') != key:
+        print(f'Discarding the feature cache {path}, it was built with another plan')
+        return None
+
+    return cache['features']
+
+
+def split_cached(data, labeled, path, key, columns=None):
+    # (cached features of the unchanged projects, raw rows of the projects to recompute, hashes of every project)
+    hashes = content_hashes(data, labeled, columns)
+
+    cache = read_cache(path, key)
+    if cache is None:
+        return None, data, hashes
+
+    cache = cache.merge(hashes, on=['id', 'row_hash', 'labeled_hash'], how='inner')
+
+    cached = cache.drop(columns=['row_hash', 'labeled_hash'])
+    data = data.loc[~data['id'].isin(cached['id'])]
+
+    return cached, data, hashes
+
+
+def merge_cached(cached, data, hashes):
+    # put the cached and recomputed projects back together, in the order of the raw data
+    if cached is not None and len(cached) > 0:
+        data = pd.concat([cached, data], ignore_index=True) if len(data) > 0 else cached
+
+    order = pd.Index(hashes['id']).drop_duplicates().get_indexer(data['id'])
+
+    return data.iloc[np.argsort(order, kind='stable')].reset_index(drop=True)
+
+
+def save_cache(path, data, hashes, key):
+    pd.to_pickle({'key': key, 'features': data.merge(hashes.drop_duplicates('id'), on='id', how='left')}, path)
+
+
+def run_cached(plan, data, labeled, path, resources=None, workers=1, run=None):
+    # plan.run on data, reusing the features of the projects that didn't change since the run cached at path
+    settings = {k: v for k, v in (resources or {}).items() if isinstance(v, (bool, int, float, str))}
+    key = {**plan.key(), 'settings': settings}
+
+    cached, data, hashes = split_cached(data, labeled, path, key)
+
+    data = plan.run(data, resources, workers=workers, run=run)
+
+    data = merge_cached(cached, data, hashes)
+    save_cache(path, data, hashes, key)
+
+    return data
@@ -0,0 +1,143 @@
+import contextlib
+import cProfile
+import datetime
+import json
+import os
+import os.path as op
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Per-stage instrumentation of the feature pipelines.
+#
+# Every named stage of a run records its wall time, CPU time, the number of rows it processed and the peak RSS of the
+# process once it is done. A stage run several times (e.g. once per chunk in stream_gofundme) is accumulated into one
+# entry. At the end of the run the stages are printed as a table and written as a JSON report. Instrumentation is off
+# unless it is enabled with the --instrument flag of create_features.py / pipeline.py or the environment variables
+# (the stages of a disabled run don't record anything):
+#
+# FEATURES_INSTRUMENT: directory the <pipeline>_report.json reports are written to.
+#
+# FEATURES_PROFILE: set to 1 to also dump a cProfile of every stage in <pipeline>_<stage>.prof in the same directory,
+# e.g. to look at with python -m pstats or snakeviz.
+#
+# rss_growth_mb is how much a stage raised the peak RSS of the process, i.e. which stages set the memory high-water mark.
+# The peak RSS of the worker processes (workers > 1) is reported separately as children_peak_rss_mb.
+
+INSTRUMENT_ENV = 'FEATURES_INSTRUMENT'
+PROFILE_ENV = 'FEATURES_PROFILE'
+
+
+def peak_rss_mb(who='self'):
+    if resource is None:
+        return None
+
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN)
+
+    # ru_maxrss is in bytes on macOS and in kilobytes everywhere else
+    return usage.ru_maxrss / 2 ** 20 if sys.platform == 'darwin' else usage.ru_maxrss / 2 ** 10
+
+
+class Run:
+
+    def __init__(self, pipeline, out_dir=None, profile=False, verbose=True, enabled=True):
+        # out_dir: where the report (and profiles) are saved, None to only keep the stages in memory
+        self.pipeline = pipeline
+        self.enabled = enabled
+        self.out_dir = out_dir
+        self.profile = profile and enabled and out_dir is not None
+        self.verbose = verbose
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.started = datetime.datetime.now()
+        self.start = time.perf_counter()
+
+        if self.enabled and self.out_dir is not None:
+            os.makedirs(self.out_dir, exist_ok=True)
+
+    @classmethod
+    def from_env(cls, pipeline, out_dir=None, profile=None, verbose=True):
+        # explicit arguments (the CLI flags) take precedence over the environment variables
+        out_dir = (os.environ.get(INSTRUMENT_ENV) or None) if out_dir is None else out_dir
+        profile = os.environ.get(PROFILE_ENV, '') not in ('', '0') if profile is None else profile
+
+        return cls(pipeline, out_dir, profile, verbose, enabled=out_dir is not None)
+
+    @contextlib.contextmanager
+    def stage(self, name, rows=None):
+        if not self.enabled:
+            yield
+            return
+
+        profiler = cProfile.Profile() if self.profile else None
+        rss_before = peak_rss_mb()
+        wall, cpu = time.perf_counter(), time.process_time()
+
+        if profiler is not None:
+            profiler.enable()
+
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            rss = peak_rss_mb()
+
+            # stages can run in several threads (see features.py), their CPU times then overlap
+            with self.lock:
+                stage = self.stages.setdefault(name, {'name': name, 'calls': 0, 'rows': None, 'wall_seconds': 0.0,
+                                                      'cpu_seconds': 0.0, 'peak_rss_mb': None, 'rss_growth_mb': 0.0})
+                stage['calls'] += 1
+                if rows is not None:
+                    stage['rows'] = (stage['rows'] or 0) + rows
+                stage['wall_seconds'] += wall
+                stage['cpu_seconds'] += cpu
+                if rss is not None:
+                    stage['peak_rss_mb'] = rss
+                    stage['rss_growth_mb'] += rss - rss_before
+
+            if profiler is not None:
+                profiler.dump_stats(op.join(self.out_dir, f'{self.pipeline}_{name}.prof'))
+
+    def report(self):
+        return {
+            'pipeline': self.pipeline,
+            'started': self.started.isoformat(timespec='seconds'),
+            'wall_seconds': time.perf_counter() - self.start,
+            'peak_rss_mb': peak_rss_mb(),
+            'children_peak_rss_mb': peak_rss_mb('children'),
+            'stages': list(self.stages.values()),
+        }
+
+    def summary(self):
+        lines = [f"  {'stage':<28} {'rows':>10} {'wall':>9} {'cpu':>9} {'peak rss':>10}"]
+        for s in self.stages.values():
+            rows = f"{s['rows']:,}" if s['rows'] is not None else ''
+            rss = f"{s['peak_rss_mb']:7.1f} MB" if s['peak_rss_mb'] is not None else ''
+            lines.append(f"  {s['name']:<28} {rows:>10} {s['wall_seconds']:7.3f} s {s['cpu_seconds']:7.3f} s {rss:>10}")
+
+        return '\n'.join(lines)
+
+    def finish(self):
+        # print the stages and save the report, when enabled; returns the report
+        report = self.report()
+
+        if self.enabled and self.verbose:
+            print(self.summary())
+
+        if self.enabled and self.out_dir is not None:
+            path = op.join(self.out_dir, f'{self.pipeline}_report.json')
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+
+            if self.verbose:
+                print(f'Saved the run report in {path}')
+
+        return report
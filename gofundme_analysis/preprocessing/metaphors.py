@@ -0,0 +1,42 @@
+import pandas as pd
+
+# Aggregate the labeled keyword fragments into per-project metaphor features.
+#
+# Every feature is built from one grouped pass over the metaphorical rows of labeled.csv (grouped by project id and
+# metaphor family) and then looked up by project id, instead of scanning labeled.csv once per project. The features
+# themselves are registered in features.py.
+#
+# *_metaphor: A count of how many keywords of the family were labeled as metaphorical in the project body text.
+#
+# *_uniques: A count of how many unique keywords of the family were labeled as metaphorical.
+#
+# *_salience: *_metaphor divided by the number of words in the project body text.
+
+METAPHOR_FAMILIES = ['battle', 'journey']
+
+# the labeled.csv columns the features are computed from (everything but the fragments)
+LABELED_FEATURE_COLUMNS = ['char_location', 'keyword', 'metaphorical', 'project_id', 'type']
+
+
+def metaphorical(labeled, families=None):
+    # keep only the fragments labeled as metaphorical (optionally restricted to some families)
+    mask = (labeled['metaphorical'] == True).fillna(False).astype(bool)
+
+    if families is not None:
+        mask &= labeled['type'].isin(families)
+
+    return labeled.loc[mask]
+
+
+def count_metaphors(labeled, families=METAPHOR_FAMILIES):
+    # one row per project id, with a *_metaphor and *_uniques column for each family (the metaphor_counts feature)
+    grouped = metaphorical(labeled, families).groupby(['project_id', 'type'], observed=True)['keyword']
+
+    sizes = grouped.size().unstack('type', fill_value=0).reindex(columns=families, fill_value=0)
+    uniques = grouped.nunique().unstack('type', fill_value=0).reindex(columns=families, fill_value=0)
+
+    features = pd.concat([sizes.add_suffix('_metaphor'), uniques.add_suffix('_uniques')], axis=1)
+    features.columns.name = None
+
+    return features.astype(int)
+
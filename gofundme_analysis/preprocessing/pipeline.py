@@ -0,0 +1,192 @@
+import argparse
+import os.path as op
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from storage import csv_path, parquet_path, read_table, write_table
+
+# Command line driver of the feature pipelines.
+#
+# Runs the features of any of the sources, each in its own process, then writes the combined Kickstarter + GoFundMe
+# table. A source whose output is newer than all of its inputs is considered finished and isn't run again (unless
+# --force), so e.g. adding GoFundMe projects and rerunning only recomputes GoFundMe before combining:
+#
+#   python preprocessing/pipeline.py                                   # kickstarter + gofundme, then combine
+#   python preprocessing/pipeline.py --sources gofundme --stages features --cache data/processed/gofundme.cache
+#   python preprocessing/pipeline.py --sources stim --reports ../experimental_analysis/planning/src/reports
+#   python preprocessing/pipeline.py --stages combine
+#   python preprocessing/pipeline.py --sources gofundme --features battle_salience journey_salience --force
+#
+# --features restricts every source to the listed features of its plan (the project ids are always kept).
+#
+# Sources:
+#
+# kickstarter: process_kickstarter in create_features.py.
+#
+# gofundme: process_gofundme in create_features.py (stream_gofundme with --chunk-size).
+#
+# stim: process in experimental_analysis/planning/stim_language_feature_comparisons.py, on the custom campaigns of the
+# --reports directory.
+
+SOURCES = ['kickstarter', 'gofundme', 'stim']
+
+# where the stim pipeline lives
+PLANNING = op.normpath(op.join(op.dirname(op.abspath(__file__)), '..', '..', 'experimental_analysis', 'planning'))
+
+STAGES = ['features', 'combine']
+
+COMBINED = ['kickstarter', 'gofundme']
+
+
+def source_paths(source, data='data', reports='src/reports', labeled=None):
+    # (input paths, output path) of a source
+    if source == 'stim':
+        return [op.join(reports, 'labeled.csv'), op.join(reports, 'projects.csv')], op.join(reports, 'projects_full.csv')
+
+    labeled = op.join(data, 'processed', 'labeled.csv') if labeled is None else labeled
+
+    return [labeled, op.join(data, 'raw', f'{source}_projects.csv')], op.join(data, 'processed', f'{source}_projects.csv')
+
+
+def modified(path):
+    # last modification time of either version of a table, None if there's none
+    times = [op.getmtime(p) for p in [csv_path(path), parquet_path(path)] if op.exists(p)]
+
+    return max(times) if times else None
+
+
+def finished(inputs, out):
+    out_time = modified(out)
+
+    return out_time is not None and all(modified(p) is None or modified(p) <= out_time for p in inputs)
+
+
+def source_plans(source):
+    # the feature plans of a source
+    if source == 'stim':
+        return [import_stim().STIM]
+
+    import create_features
+
+    if source == 'kickstarter':
+        return [create_features.KICKSTARTER]
+
+    return [create_features.GOFUNDME, create_features.GOFUNDME_RARITY]
+
+
+def import_stim():
+    # experimental_analysis/planning/stim_language_feature_comparisons.py
+    if PLANNING not in sys.path:
+        sys.path.append(PLANNING)
+
+    import stim_language_feature_comparisons
+
+    return stim_language_feature_comparisons
+
+
+def run_source(source, inputs, out, workers=1, instrument=None, profile=None, cache=None, rarity_weights=None,
+               chunk_size=None, features=None, fast_words=False):
+    # features of one source, run in a worker process
+    from instrument import Run
+
+    run = Run.from_env(source, instrument, profile)
+
+    if source == 'stim':
+        import_stim().process(workers=workers, run=run, features=features, fast_words=fast_words,
+                              labeled_path=inputs[0], projects_path=inputs[1], out_path=out)
+        return out
+
+    import create_features
+
+    labeled_path, raw_path = inputs
+
+    if source == 'kickstarter':
+        create_features.process_kickstarter(workers=workers, run=run, features=features, fast_words=fast_words,
+                                            labeled_path=labeled_path, raw_path=raw_path, out_path=out)
+    elif chunk_size is not None:
+        create_features.stream_gofundme(chunk_size=chunk_size, rarity_weights=rarity_weights, workers=workers, run=run,
+                                        features=features, fast_words=fast_words, labeled_path=labeled_path,
+                                        raw_path=raw_path, out_path=out)
+    else:
+        create_features.process_gofundme(rarity_weights=rarity_weights, workers=workers, cache=cache, run=run,
+                                         features=features, fast_words=fast_words, labeled_path=labeled_path,
+                                         raw_path=raw_path, out_path=out)
+
+    return out
+
+
+def run_features(sources, paths, force=False, **kwargs):
+    # run the unfinished sources concurrently, one process each
+    todo = [s for s in sources if force or not finished(*paths[s])]
+
+    for source in sources:
+        if source not in todo:
+            print(f'{source}: {paths[source][1]} is up to date')
+
+    if len(todo) == 1:
+        run_source(todo[0], *paths[todo[0]], **kwargs)
+    elif len(todo) > 1:
+        with ProcessPoolExecutor(max_workers=len(todo)) as pool:
+            futures = {s: pool.submit(run_source, s, *paths[s], **kwargs) for s in todo}
+            for source, future in futures.items():
+                future.result()
+
+    return todo
+
+
+def combine(paths, out):
+    # the Kickstarter and GoFundMe features in one table, from their existing outputs
+    missing = [paths[s][1] for s in COMBINED if modified(paths[s][1]) is None]
+    if missing:
+        raise SystemExit(f"Can't combine the projects, run the features first: {', '.join(missing)} missing")
+
+    combined = pd.concat([read_table(paths[s][1]) for s in COMBINED], axis=0, ignore_index=True, sort=False)
+
+    write_table(combined, out)
+    print(f'Projects Combined into {out}')
+
+    return combined
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the feature pipelines and combine their outputs')
+    parser.add_argument('--sources', nargs='+', choices=SOURCES, default=COMBINED)
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--data', default='data', help='directory with the raw/ and processed/ tables')
+    parser.add_argument('--labeled', help='labeled fragments of the Kickstarter and GoFundMe projects '
+                                          '(default: DATA/processed/labeled.csv)')
+    parser.add_argument('--reports', default='src/reports', help='directory with the custom campaigns (stim)')
+    parser.add_argument('--combined', help='combined output (default: DATA/processed/combined_projects.csv)')
+    parser.add_argument('--force', action='store_true', help='rerun the sources even if their outputs are up to date')
+    parser.add_argument('--workers', type=int, default=1, help='tokenization processes per source')
+    parser.add_argument('--cache', help='incremental GoFundMe feature cache, see incremental.py')
+    parser.add_argument('--rarity-weights', help='GoFundMe keyword weights file, see rarity.py')
+    parser.add_argument('--chunk-size', type=int, help='process the GoFundMe projects in chunks (stream_gofundme)')
+    parser.add_argument('--instrument', metavar='DIR', help='save per-stage run reports in DIR, see instrument.py')
+    parser.add_argument('--profile', action='store_true', default=None, help='also dump a cProfile of every stage')
+    parser.add_argument('--features', nargs='+', help='only compute these features (default: all of every source)')
+    parser.add_argument('--fast-words', action='store_true',
+                        help='count the words without building token lists, see text_length.py')
+    args = parser.parse_args()
+
+    paths = {s: source_paths(s, args.data, args.reports, args.labeled) for s in SOURCES}
+
+    if args.features is not None and 'features' in args.stages:
+        known = {c for s in args.sources for plan in source_plans(s) for c in plan.columns}
+        unknown = [f for f in args.features if f not in known]
+        if unknown:
+            parser.error(f"no feature of {', '.join(args.sources)} is named {', '.join(unknown)}")
+
+    if 'features' in args.stages:
+        run_features(args.sources, paths, force=args.force, workers=args.workers, instrument=args.instrument,
+                     profile=args.profile, cache=args.cache, rarity_weights=args.rarity_weights,
+                     chunk_size=args.chunk_size, features=args.features, fast_words=args.fast_words)
+
+    if 'combine' in args.stages:
+        combine(paths, args.combined or op.join(args.data, 'processed', 'combined_projects.csv'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+import pandas as pd
+
+from metaphors import metaphorical
+
+# Create features related to where metaphors appear in each project.
+#
+# Positions are relative: the char_location of a metaphorical keyword divided by the length of the project text + 1.
+# Text lengths are looked up once through an id -> length array and every statistic is one grouped reduction, so no
+# project is ever filtered out of labeled.csv or data individually. The features are registered in features.py.
+#
+# first_instantiation: position of the first metaphor of any family.
+#
+# *_early: position of the first metaphor of the family.
+#
+# *_late: position of the last metaphor of the family.
+#
+# *_mean_position: mean position of the metaphors of the family.
+#
+# *_spread: standard deviation of the positions of the metaphors of the family (0 for a single metaphor).
+#
+# Projects without a metaphor of the family get -1 for every statistic.
+
+POSITION_STATS = {
+    'early': lambda g: g.min(),
+    'late': lambda g: g.max(),
+    'mean_position': lambda g: g.mean(),
+    'spread': lambda g: g.std(ddof=0),
+}
+
+
+def relative_positions(data, labeled, families=None):
+    # metaphorical fragments of the projects in data, with their relative position in the project text
+    projects = data.drop_duplicates('id')
+    lengths = projects['text'].str.len().values + 1
+
+    met = metaphorical(labeled, families)
+    rows = pd.Index(projects['id']).get_indexer(met['project_id'])
+    found = rows >= 0
+
+    positions = met.loc[found, ['project_id', 'type']]
+    positions['position'] = met['char_location'].values[found] / lengths[rows[found]]
+
+    return positions
+
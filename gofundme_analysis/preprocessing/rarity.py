@@ -0,0 +1,127 @@
+import os.path as op
+
+import numpy as np
+import pandas as pd
+
+from metaphors import METAPHOR_FAMILIES, metaphorical
+
+# Create features related to how rare the metaphor keywords of each project are.
+#
+# Every keyword of a family gets a weight of (total / count) ** r, normalized so that the most common keyword has
+# weight 1 (see exploration/measuring_productivity.ipynb). The weights live in a (family x keyword) NumPy array and
+# fragments are mapped to integer codes into it, so the per-project sums are a single bincount. The features are
+# registered in features.py.
+#
+# *_rare: sum of the weights of the family keywords found in the project.
+#
+# *_prod: *_rare divided by the number of family keywords found in the project (0 if there are none).
+
+R = 0.4
+
+
+def weights_path(path):
+    # np.savez appends .npz to paths without it, so the table is always looked for there
+    return path if path.endswith('.npz') else path + '.npz'
+
+
+class KeywordWeights:
+
+    def __init__(self, weights):
+        # weights: {family: {keyword: weight}}
+        self.families = pd.Index(list(weights))
+        self.keywords = pd.Index(sorted({k for family in weights.values() for k in family}))
+
+        self.table = np.zeros((len(self.families), len(self.keywords)))
+        for f, family in enumerate(weights.values()):
+            self.table[f, self.keywords.get_indexer(list(family))] = list(family.values())
+
+    @classmethod
+    def fit(cls, labeled, families=METAPHOR_FAMILIES, r=R):
+        return cls.from_counts(keyword_counts(labeled, families), r)
+
+    @classmethod
+    def from_counts(cls, counts, r=R):
+        # counts: {family: number of instances of each metaphor keyword}
+        weights = {}
+
+        for family, vc in counts.items():
+            freq_map = (vc.sum() / vc) ** r
+            weights[family] = dict(freq_map / freq_map.min())
+
+        return cls(weights)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(weights_path(path)) as f:
+            weights = cls.__new__(cls)
+            weights.families = pd.Index(f['families'])
+            weights.keywords = pd.Index(f['keywords'])
+            weights.table = f['table']
+
+        return weights
+
+    @classmethod
+    def load_or_fit(cls, path, labeled, families=METAPHOR_FAMILIES, r=R):
+        # reuse a saved table if there is one, otherwise fit it and save it for the next run
+        if op.exists(weights_path(path)):
+            return cls.load(path)
+
+        weights = cls.fit(labeled, families, r)
+        weights.save(path)
+
+        return weights
+
+    def save(self, path):
+        np.savez(weights_path(path), families=self.families.values.astype(str), keywords=self.keywords.values.astype(str),
+                 table=self.table)
+
+    def to_dict(self):
+        return {
+            family: {k: w for k, w in zip(self.keywords, self.table[f]) if w > 0}
+            for f, family in enumerate(self.families)
+        }
+
+    def codes(self, fragments):
+        # (family, keyword) codes of each fragment, -1 for families / keywords without a weight
+        return self.families.get_indexer(fragments['type']), self.keywords.get_indexer(fragments['keyword'])
+
+
+def keyword_counts(labeled, families=METAPHOR_FAMILIES):
+    # count the number of instances for each metaphor keyword
+    counts = {}
+
+    for family in families:
+        vc = metaphorical(labeled, [family])['keyword'].value_counts()
+        counts[family] = vc[vc > 0]
+
+    return counts
+
+
+def sum_keyword_counts(counts):
+    # add up the keyword_counts of several chunks of labeled.csv
+    families = list(dict.fromkeys(family for c in counts for family in c))
+
+    return {family: pd.concat([c[family] for c in counts if family in c]).groupby(level=0, observed=True).sum()
+            for family in families}
+
+
+def keyword_scores(data, fragments, weights):
+    # summed keyword weights and keyword counts per (row of data, family)
+    projects = pd.Index(data['id'].unique())
+    rows = projects.get_indexer(fragments['project_id'])
+    fam_codes, kw_codes = weights.codes(fragments)
+
+    known = (rows >= 0) & (fam_codes >= 0) & fragments['keyword'].notna().values
+    weighted = known & (kw_codes >= 0)
+
+    n = len(projects) * len(weights.families)
+    slots = rows * len(weights.families) + fam_codes
+
+    sums = np.bincount(slots[weighted], weights=weights.table[fam_codes[weighted], kw_codes[weighted]], minlength=n)
+    counts = np.bincount(slots[known], minlength=n)
+
+    shape = (len(projects), len(weights.families))
+    ix = projects.get_indexer(data['id'])
+
+    return sums.reshape(shape)[ix], counts.reshape(shape)[ix]
+
@@ -0,0 +1,81 @@
+import pandas as pd
+
+import features
+from features import FEATURES, Plan, Registry
+from incremental import run_cached
+
+# python -m pytest preprocessing/test_incremental.py
+
+REGISTRY = Registry(FEATURES)
+
+# projects each feature was computed for
+COMPUTED = []
+
+
+@REGISTRY.register('doubled', ['goal'])
+def doubled(goal):
+    COMPUTED.append(len(goal))
+    return goal * 2
+
+
+@REGISTRY.register('halved', ['goal'])
+def halved(goal):
+    COMPUTED.append(len(goal))
+    return goal / 2
+
+
+def projects():
+    return pd.DataFrame({'id': ['a', 'b', 'c'], 'goal': [10, 20, 30]})
+
+
+def labeled():
+    return pd.DataFrame({'project_id': ['a'], 'keyword': ['fight']})
+
+
+def test_unchanged_projects_come_from_the_cache(tmp_path):
+    cache = str(tmp_path / 'features.cache')
+    plan = Plan(['doubled'], registry=REGISTRY)
+
+    first = run_cached(plan, projects(), labeled(), cache)
+    COMPUTED.clear()
+    second = run_cached(plan, projects(), labeled(), cache)
+
+    assert COMPUTED == [0]
+    pd.testing.assert_frame_equal(first, second)
+
+
+def test_changing_the_plan_discards_the_cache(tmp_path):
+    cache = str(tmp_path / 'features.cache')
+
+    run_cached(Plan(['doubled'], registry=REGISTRY), projects(), labeled(), cache)
+
+    plan = Plan(['doubled', 'halved'], registry=REGISTRY)
+    cached = run_cached(plan, projects(), labeled(), cache)
+
+    pd.testing.assert_frame_equal(cached, plan.run(projects()))
+    assert cached['halved'].notna().all()
+
+
+def test_changing_the_feature_version_discards_the_cache(tmp_path, monkeypatch):
+    cache = str(tmp_path / 'features.cache')
+    plan = Plan(['doubled'], registry=REGISTRY)
+
+    run_cached(plan, projects(), labeled(), cache)
+
+    monkeypatch.setattr(features, 'VERSION', features.VERSION + '-changed')
+    COMPUTED.clear()
+    run_cached(plan, projects(), labeled(), cache)
+
+    assert COMPUTED == [3]
+
+
+def test_changing_a_resource_setting_discards_the_cache(tmp_path):
+    cache = str(tmp_path / 'features.cache')
+    plan = Plan(['doubled'], registry=REGISTRY)
+
+    run_cached(plan, projects(), labeled(), cache, {'fast_words': False})
+
+    COMPUTED.clear()
+    run_cached(plan, projects(), labeled(), cache, {'fast_words': True})
+
+    assert COMPUTED == [3]
@@ -0,0 +1,60 @@
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import nltk
+import pandas as pd
+from nltk.tokenize import RegexpTokenizer
+
+# Word and sentence counts of the project texts.
+#
+# The text column is split into chunks that are tokenized in a process pool (workers=1 keeps everything in this
+# process). The counts are the same as tokenizing the whole column with RegexpTokenizer(r'\w+') and
+# nltk.sent_tokenize; non-string texts count as 0.
+#
+# fast=True counts words by iterating over the matches of the compiled pattern, without building token lists. It
+# follows Python's re definition of \w, which newer nltk releases no longer use for a handful of unicode characters.
+
+WORD = r'\w+'
+
+tokenizer = RegexpTokenizer(WORD)
+word_pattern = re.compile(WORD)
+
+
+def count_words(text, fast=False):
+    if not isinstance(text, str):
+        return 0
+
+    if fast:
+        return sum(1 for _ in word_pattern.finditer(text))
+
+    return len(tokenizer.tokenize(text))
+
+
+def count_sentences(text):
+    return len(nltk.sent_tokenize(text)) if isinstance(text, str) else 0
+
+
+def _count_chunk(texts, sentences, fast):
+    words = [count_words(t, fast) for t in texts]
+    sents = [count_sentences(t) for t in texts] if sentences else None
+
+    return words, sents
+
+
+def text_lengths(texts, sentences=True, fast=False, workers=1, chunk_size=5000):
+    # text_length_words (and text_length_sentences) for every text, aligned with the index of texts
+    values = list(texts)
+    chunks = [values[i:i + chunk_size] for i in range(0, len(values), chunk_size)]
+
+    if workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_count_chunk, chunks, [sentences] * len(chunks), [fast] * len(chunks)))
+    else:
+        results = [_count_chunk(c, sentences, fast) for c in chunks]
+
+    lengths = pd.DataFrame(index=texts.index)
+    lengths['text_length_words'] = [n for words, _ in results for n in words]
+    if sentences:
+        lengths['text_length_sentences'] = [n for _, sents in results for n in sents]
+
+    return lengths.astype(int)